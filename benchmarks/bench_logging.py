@@ -0,0 +1,129 @@
+"""
+Event-loop cost of one log call, old pipeline vs. current.
+
+Times logger.info() from inside a coroutine, i.e. what a request handler pays
+per log line, for:
+
+  legacy   StreamHandler + dict/json.dumps formatter, default record fields
+  queue    main.configure_logging(): LogQueueHandler + listener thread
+  sampled  main.log_success() at a 1% sample rate on the queue pipeline
+
+Log lines go to a pipe drained by a child process at --reader-bps bytes per
+second, standing in for a log shipper that falls behind. Synchronous handlers
+stall the loop once the pipe buffer fills; the queue keeps it free.
+
+Run with:  uv run python benchmarks/bench_logging.py [--calls 20000] [--reader-bps 0]
+
+--reader-bps 0 (the default) drains as fast as possible.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+READER = """
+import os, sys, time
+bps = int(sys.argv[1])
+while True:
+    chunk = os.read(0, 4096)
+    if not chunk:
+        break
+    if bps:
+        time.sleep(len(chunk) / bps)
+"""
+
+
+class LegacyJsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(
+            {
+                "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+                "level": record.levelname,
+                "message": record.getMessage(),
+                "logger": record.name,
+            }
+        )
+
+
+def start_reader(reader_bps):
+    _read, _write = os.pipe()
+    _reader = subprocess.Popen(
+        [sys.executable, "-c", READER, str(reader_bps)], stdin=_read, close_fds=True
+    )
+    os.close(_read)
+
+    return _reader, os.fdopen(_write, "w")
+
+
+async def time_calls(log, calls):
+    _durations = []
+
+    for _i in range(calls):
+        _start = time.perf_counter()
+        log(f"Sucussfully requested API page {_i}")
+        _durations.append(time.perf_counter() - _start)
+
+    return _durations
+
+
+def summary(name, durations):
+    _sorted = sorted(durations)
+
+    return (
+        f"{name:<8} mean {statistics.fmean(durations) * 1e6:8.2f} µs"
+        f"  p99 {_sorted[int(len(_sorted) * 0.99)] * 1e6:8.2f} µs"
+        f"  max {_sorted[-1] * 1e3:8.2f} ms"
+    )
+
+
+async def run(calls, reader_bps):
+    _results = {}
+
+    _reader, _stream = start_reader(reader_bps)
+    _legacy = logging.getLogger("bench-legacy")
+    _legacy.propagate = False
+    _legacy.setLevel(logging.INFO)
+    _handler = logging.StreamHandler(_stream)
+    _handler.setFormatter(LegacyJsonFormatter())
+    _legacy.addHandler(_handler)
+    _results["legacy"] = await time_calls(_legacy.info, calls)
+    _stream.close()
+    _reader.wait()
+
+    _reader, _stream = start_reader(reader_bps)
+    sys.stdout = _stream
+    main.logger.propagate = False
+    main.configure_logging("INFO", queue_size=calls)
+    _results["queue"] = await time_calls(main.logger.info, calls)
+
+    main.logging_config["success_sample_rate"] = 0.01
+    _results["sampled"] = await time_calls(main.log_success, calls)
+
+    return _results
+
+
+def main_(argv=None):
+    _parser = argparse.ArgumentParser(description="Event-loop cost of one log call")
+    _parser.add_argument("--calls", type=int, default=20000)
+    _parser.add_argument("--reader-bps", type=int, default=0)
+    _args = _parser.parse_args(argv)
+
+    _results = asyncio.run(run(_args.calls, _args.reader_bps))
+
+    for _name, _durations in _results.items():
+        print(summary(_name, _durations), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_()
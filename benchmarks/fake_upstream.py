@@ -0,0 +1,146 @@
+"""
+Local stand-in for the Rick and Morty API, for load tests.
+
+Serves /api/character, /api/location and /api/episode with the real API's
+page shape ({"info": {...}, "results": [...]}, 20 records per page) from
+generated, deterministic records. Filters are accepted and ignored. Pages
+carry an ETag and a matching If-None-Match is answered 304, like the real API.
+
+Run with:  uv run python benchmarks/fake_upstream.py --port 8801 --pages 42 \\
+               --latency 0.05 --error-rate 0.01 --throttle-rate 0.01
+
+and point a sync at it with upstream.scheme: http and source_url=127.0.0.1:8801.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Response
+
+PAGE_SIZE = 20
+
+STATUSES = ("Alive", "Dead", "unknown")
+SPECIES = ("Human", "Alien", "Humanoid", "Robot", "Animal")
+GENDERS = ("Male", "Female", "Genderless", "unknown")
+ORIGINS = ("Earth (C-137)", "Earth (Replacement Dimension)", "Abadango", "unknown")
+
+
+def make_record(resource, record_id):
+    # Deterministic per id, so repeated syncs see an unchanged upstream
+    _rng = random.Random(f"{resource}:{record_id}")  # nosec B311 - test data
+
+    match resource:
+        case "character":
+            _origin = _rng.choice(ORIGINS)
+            return {
+                "id": record_id,
+                "name": f"Character {record_id}",
+                "status": _rng.choice(STATUSES),
+                "species": _rng.choice(SPECIES),
+                "type": "",
+                "gender": _rng.choice(GENDERS),
+                "origin": {"name": _origin, "url": ""},
+                "location": {"name": _rng.choice(ORIGINS), "url": ""},
+                "image": f"https://rickandmortyapi.com/api/character/avatar/{record_id}.jpeg",
+                "episode": [
+                    f"https://rickandmortyapi.com/api/episode/{_rng.randint(1, 51)}"
+                    for _ in range(_rng.randint(1, 8))
+                ],
+                "url": f"https://rickandmortyapi.com/api/character/{record_id}",
+                "created": "2017-11-04T18:48:46.250Z",
+            }
+        case "location":
+            return {
+                "id": record_id,
+                "name": f"Location {record_id}",
+                "type": _rng.choice(("Planet", "Space station", "Microverse")),
+                "dimension": _rng.choice(("Dimension C-137", "unknown")),
+                "residents": [],
+                "url": f"https://rickandmortyapi.com/api/location/{record_id}",
+                "created": "2017-11-10T12:42:04.162Z",
+            }
+        case _:
+            return {
+                "id": record_id,
+                "name": f"Episode {record_id}",
+                "air_date": "December 2, 2013",
+                "episode": f"S01E{record_id:02d}",
+                "characters": [],
+                "url": f"https://rickandmortyapi.com/api/episode/{record_id}",
+                "created": "2017-11-10T12:56:33.798Z",
+            }
+
+
+def create_app(pages=42, latency=0.0, error_rate=0.0, throttle_rate=0.0):
+    app = FastAPI()
+    _cache: dict = {}
+
+    @app.get("/api/{resource}")
+    async def listing(resource: str, page: int = 1, if_none_match: str | None = Header(None)):
+        if resource not in ("character", "location", "episode"):
+            raise HTTPException(status_code=404, detail="There is nothing here")
+
+        if latency:
+            await asyncio.sleep(latency)
+
+        _roll = random.random()  # nosec B311 - fault injection
+        if _roll < throttle_rate:
+            return Response(status_code=429, headers={"Retry-After": "0"})
+        if _roll < throttle_rate + error_rate:
+            return Response(status_code=500)
+
+        if not 1 <= page <= pages:
+            raise HTTPException(status_code=404, detail="There is nothing here")
+
+        _key = (resource, page)
+        if _key not in _cache:
+            _first = (page - 1) * PAGE_SIZE + 1
+            _body = json.dumps(
+                {
+                    "info": {
+                        "count": pages * PAGE_SIZE,
+                        "pages": pages,
+                        "next": None,
+                        "prev": None,
+                    },
+                    "results": [
+                        make_record(resource, _id) for _id in range(_first, _first + PAGE_SIZE)
+                    ],
+                }
+            ).encode()
+            _cache[_key] = (_body, f'W/"{hashlib.sha256(_body).hexdigest()[:27]}"')
+
+        _body, _etag = _cache[_key]
+
+        if if_none_match == _etag:
+            return Response(status_code=304, headers={"ETag": _etag})
+
+        return Response(content=_body, media_type="application/json", headers={"ETag": _etag})
+
+    return app
+
+
+def main(argv=None):
+    _parser = argparse.ArgumentParser(description="Local Rick and Morty API stand-in")
+    _parser.add_argument("--host", default="127.0.0.1")
+    _parser.add_argument("--port", type=int, default=8801)
+    _parser.add_argument("--pages", type=int, default=42, help="pages per resource")
+    _parser.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+    _parser.add_argument("--error-rate", type=float, default=0.0, help="fraction answered 500")
+    _parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction answered 429")
+    _args = _parser.parse_args(argv)
+
+    uvicorn.run(
+        create_app(_args.pages, _args.latency, _args.error_rate, _args.throttle_rate),
+        host=_args.host,
+        port=_args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
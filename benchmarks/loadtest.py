@@ -0,0 +1,394 @@
+"""
+Load test: the app against a local upstream stand-in and a local Postgres.
+
+Starts benchmarks/fake_upstream.py and `python main.py` as subprocesses, then:
+
+  sync    POST /sync?resource=all (full), then again in incremental mode
+          against the unchanged upstream; reports wall time and records/s
+  data    GET /data over a mix of sorts, filters and page sizes
+  stats   GET /stats over all and single dimensions
+  search  GET /search over typeahead-style name prefixes
+  db-mon  GET /db-mon over the records, conn, pool and cache aspects
+
+data, stats, search and db-mon run --concurrency clients for --duration seconds each and
+report throughput and p50/p95/p99 latency. Peak RSS is the sum of the
+high-water marks of the app's processes (Linux /proc).
+
+The load is driven from this process; on a machine with few cores it competes
+with the app and the stand-in for CPU, so compare runs from the same machine.
+
+Postgres must accept TCP on port 5432 (the app's DSN is fixed to it), e.g.
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:16-alpine
+
+The --db-name database is dropped and recreated on every run.
+
+--page-cache DIR keeps the app's upstream page cache there. A first run in the
+default revalidate mode records every page; later runs with
+--page-cache-mode replay sync from that snapshot without contacting the
+upstream, so the ingest path is measured on its own. Entries are keyed by URL, so pin the
+stand-in with --upstream-port when recording and replaying.
+
+Run with:  uv run python benchmarks/loadtest.py --db-password postgres
+           uv run python benchmarks/loadtest.py --db-password postgres --compare
+           uv run python benchmarks/loadtest.py --db-password postgres --save-baseline
+
+--compare exits 1 when a metric is worse than benchmarks/baseline.json by more
+than --tolerance. Baselines are machine-specific: record one on the machine
+that runs the comparison.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncpg
+import httpx
+import yaml
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+BASELINE_PATH = ROOT / "benchmarks" / "baseline.json"
+
+DATA_QUERIES = (
+    "sort_field=id&sort_order=ASC&limit=20",
+    "sort_field=id&sort_order=DESC&limit=100",
+    "sort_field=data&sort_order=ASC&limit=20",
+    "sort_field=id&sort_order=ASC&status=Alive&limit=50",
+    "sort_field=id&sort_order=ASC&species=Human&gender=Female",
+    "sort_field=id&sort_order=ASC&origin=Earth (C-137)&limit=20",
+    "sort_field=id&sort_order=ASC&name=Character 1",
+    "sort_field=id&sort_order=ASC&fields=id,name,status&limit=200",
+    "sort_field=id&sort_order=ASC",
+)
+STATS_QUERIES = ("", "dimension=status", "dimension=origin&limit=10", "dimension=location")
+SEARCH_QUERIES = (
+    "q=c",
+    "q=char",
+    "q=character 1",
+    "q=character 4&limit=5",
+    "q=character 42",
+    "q=character&offset=20",
+    "q=character 1&fields=id,name",
+    "q=nobody",
+)
+DB_MON_QUERIES = ("aspect=records", "aspect=conn", "aspect=pool", "aspect=cache")
+
+# Settings that change what is measured; --compare warns when they differ
+SETTINGS = (
+    "pages",
+    "latency",
+    "error_rate",
+    "throttle_rate",
+    "concurrency",
+    "duration",
+    "workers",
+    "upstream_concurrency",
+    "no_cache",
+    "page_cache_mode",
+)
+
+
+def free_port():
+    with socket.socket() as _sock:
+        _sock.bind(("127.0.0.1", 0))
+        return _sock.getsockname()[1]
+
+
+def write_config(directory, args, port):
+    _config = {
+        "log_level": "WARNING",
+        "upstream": {
+            "scheme": "http",
+            "concurrency": args.upstream_concurrency,
+            "backoff_base": 0.05,
+            "backoff_max": 1,
+        },
+        # One client drives all load; keep the limiter out of the measurement
+        "rate_limit": {"store": "memory", "capacity": 10**9, "refill_per_second": 10**9},
+        "cache": {"max_entries": 0 if args.no_cache else 256},
+        "server": {"host": "127.0.0.1", "port": port, "access_log": False},
+    }
+    if args.page_cache:
+        _config["page_cache"] = {"dir": args.page_cache, "mode": args.page_cache_mode}
+    _secrets = {
+        "host": args.db_host,
+        "user": args.db_user,
+        "password": args.db_password,
+        "dbname": args.db_name,
+    }
+
+    _config_path = directory / "config.yaml"
+    _secret_path = directory / "secrets.json"
+    _config_path.write_text(yaml.safe_dump(_config))
+    _secret_path.write_text(json.dumps(_secrets))
+
+    return _config_path, _secret_path
+
+
+async def reset_database(args):
+    _conn = await asyncpg.connect(
+        host=args.db_host, port=5432, user=args.db_user, password=args.db_password
+    )
+    try:
+        await _conn.execute(f'DROP DATABASE IF EXISTS "{args.db_name}" WITH (FORCE)')
+    finally:
+        await _conn.close()
+
+
+def process_tree(pid):
+    _pids = [pid]
+
+    for _task in pathlib.Path(f"/proc/{pid}/task").glob("*"):
+        _children = (_task / "children").read_text().split()
+        for _child in _children:
+            _pids.extend(process_tree(int(_child)))
+
+    return _pids
+
+
+def peak_rss_mb(pid):
+    _total = 0
+
+    for _pid in process_tree(pid):
+        for _line in pathlib.Path(f"/proc/{_pid}/status").read_text().splitlines():
+            if _line.startswith("VmHWM:"):
+                _total += int(_line.split()[1])
+
+    return round(_total / 1024, 1)
+
+
+async def wait_ready(client, url, timeout=60):
+    _deadline = time.monotonic() + timeout
+
+    while time.monotonic() < _deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+
+    raise SystemExit(f"{url} not ready after {timeout}s")
+
+
+def latency_summary(latencies, errors, elapsed):
+    _cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(_cuts[49] * 1000, 2),
+        "p95_ms": round(_cuts[94] * 1000, 2),
+        "p99_ms": round(_cuts[98] * 1000, 2),
+    }
+
+
+async def drive(client, base_url, path, queries, concurrency, duration):
+    _latencies: list[float] = []
+    _errors = 0
+    _deadline = time.monotonic() + duration
+
+    async def _client(offset):
+        nonlocal _errors
+        _i = offset
+
+        while time.monotonic() < _deadline:
+            _start = time.perf_counter()
+            _resp = await client.get(f"{base_url}{path}?{queries[_i % len(queries)]}")
+            _latencies.append(time.perf_counter() - _start)
+            _errors += _resp.status_code >= 400
+            _i += 1
+
+    _start = time.monotonic()
+    await asyncio.gather(*(_client(_n) for _n in range(concurrency)))
+
+    return latency_summary(_latencies, _errors, time.monotonic() - _start)
+
+
+async def run_sync(client, base_url, source_url, mode):
+    _start = time.monotonic()
+    _resp = await client.post(
+        f"{base_url}/sync", params={"source_url": source_url, "resource": "all", "mode": mode}
+    )
+    _resp.raise_for_status()
+    _job_id = _resp.json()["job_id"]
+
+    while True:
+        _job = (await client.get(f"{base_url}/sync/{_job_id}")).json()
+        if _job["status"] not in ("queued", "running"):
+            break
+        await asyncio.sleep(0.05)
+
+    return {
+        "status": _job["status"],
+        "seconds": round(time.monotonic() - _start, 2),
+        "records_per_second": round(_job["records_per_second"], 1),
+    }
+
+
+async def run(args):
+    _upstream_port = args.upstream_port or free_port()
+    _app_port = free_port()
+    _base_url = f"http://127.0.0.1:{_app_port}"
+    _results: dict = {}
+
+    await reset_database(args)
+
+    with tempfile.TemporaryDirectory() as _tmp:
+        _config_path, _secret_path = write_config(pathlib.Path(_tmp), args, _app_port)
+
+        _upstream = subprocess.Popen(
+            [
+                sys.executable,
+                str(ROOT / "benchmarks" / "fake_upstream.py"),
+                f"--port={_upstream_port}",
+                f"--pages={args.pages}",
+                f"--latency={args.latency}",
+                f"--error-rate={args.error_rate}",
+                f"--throttle-rate={args.throttle_rate}",
+            ]
+        )
+        _app = subprocess.Popen(
+            [
+                sys.executable,
+                str(ROOT / "main.py"),
+                f"--config={_config_path}",
+                f"--secret={_secret_path}",
+                f"--workers={args.workers}",
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+
+        _limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=_limits, timeout=60, trust_env=False) as _client:
+            try:
+                await wait_ready(_client, f"http://127.0.0.1:{_upstream_port}/api/episode")
+                await wait_ready(_client, f"{_base_url}/readyz")
+
+                if "sync" in args.scenarios:
+                    _source = f"127.0.0.1:{_upstream_port}"
+                    _results["sync_full"] = await run_sync(_client, _base_url, _source, "full")
+                    _results["sync_incremental"] = await run_sync(
+                        _client, _base_url, _source, "incremental"
+                    )
+
+                for _name, _path, _queries in (
+                    ("data", "/data", DATA_QUERIES),
+                    ("stats", "/stats", STATS_QUERIES),
+                    ("search", "/search", SEARCH_QUERIES),
+                    ("db-mon", "/db-mon", DB_MON_QUERIES),
+                ):
+                    if _name in args.scenarios:
+                        _results[_name] = await drive(
+                            _client, _base_url, _path, _queries, args.concurrency, args.duration
+                        )
+
+                _results["peak_rss_mb"] = peak_rss_mb(_app.pid)
+            finally:
+                for _process in (_app, _upstream):
+                    _process.terminate()
+                    _process.wait()
+
+    return _results
+
+
+def regressions(results, baseline, tolerance):
+    _found = []
+
+    def _walk(current, previous, prefix):
+        for _key, _value in current.items():
+            _name = f"{prefix}{_key}"
+            _old = previous.get(_key) if isinstance(previous, dict) else None
+
+            if isinstance(_value, dict):
+                _walk(_value, _old, f"{_name}.")
+            elif _key == "status" and _value != "succeeded":
+                _found.append(f"{_name}: {_value}")
+            elif _key == "errors" and _value > (_old or 0):
+                _found.append(f"{_name}: {_value} (baseline {_old})")
+            elif not isinstance(_old, int | float) or isinstance(_value, str):
+                continue
+            elif _key.endswith("_per_second") and _value < _old * (1 - tolerance):
+                _found.append(f"{_name}: {_value} < {_old}")
+            elif _key.endswith(("_ms", "seconds", "_mb")) and _value > _old * (1 + tolerance):
+                _found.append(f"{_name}: {_value} > {_old}")
+
+    _walk(results, baseline, "")
+
+    return _found
+
+
+def parse_args(argv=None):
+    _parser = argparse.ArgumentParser(description="Load test against a local upstream")
+    _parser.add_argument("--db-host", default=os.environ.get("PGHOST", "127.0.0.1"))
+    _parser.add_argument("--db-user", default=os.environ.get("PGUSER", "postgres"))
+    _parser.add_argument("--db-password", default=os.environ.get("PGPASSWORD", ""))
+    _parser.add_argument("--db-name", default="rickandmorty_bench")
+    _parser.add_argument("--pages", type=int, default=42, help="upstream pages per resource")
+    _parser.add_argument("--latency", type=float, default=0.02, help="upstream seconds per page")
+    _parser.add_argument("--error-rate", type=float, default=0.0, help="upstream 500 fraction")
+    _parser.add_argument("--throttle-rate", type=float, default=0.0, help="upstream 429 fraction")
+    _parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    _parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    _parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    _parser.add_argument("--upstream-concurrency", type=int, default=8)
+    _parser.add_argument("--no-cache", action="store_true", help="disable the /data cache")
+    _parser.add_argument("--page-cache", help="directory of the app's upstream page cache")
+    _parser.add_argument(
+        "--page-cache-mode", default="revalidate", choices=["revalidate", "replay"]
+    )
+    _parser.add_argument("--upstream-port", type=int, default=0, help="stand-in port (0: any)")
+    _parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=["sync", "data", "stats", "search", "db-mon"],
+        choices=["sync", "data", "stats", "search", "db-mon"],
+    )
+    _parser.add_argument("--output", help="write results as JSON to this file")
+    _parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    _parser.add_argument("--save-baseline", action="store_true")
+    _parser.add_argument("--compare", action="store_true", help="exit 1 on regression")
+    _parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change")
+
+    return _parser.parse_args(argv)
+
+
+def main(argv=None):
+    _args = parse_args(argv)
+    _settings = {_name: getattr(_args, _name) for _name in SETTINGS}
+    _results = asyncio.run(run(_args))
+    _report = {"settings": _settings, "results": _results}
+
+    print(json.dumps(_report, indent=2))
+
+    if _args.output:
+        pathlib.Path(_args.output).write_text(json.dumps(_report, indent=2) + "\n")
+
+    if _args.save_baseline:
+        pathlib.Path(_args.baseline).write_text(json.dumps(_report, indent=2) + "\n")
+
+    if _args.compare:
+        _baseline = json.loads(pathlib.Path(_args.baseline).read_text())
+
+        if _baseline["settings"] != _settings:
+            print(f"warning: baseline settings differ: {_baseline['settings']}", file=sys.stderr)
+
+        _found = regressions(_results, _baseline["results"], _args.tolerance)
+        for _line in _found:
+            print(f"regression: {_line}", file=sys.stderr)
+
+        if _found:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ Run with:  uv run pytest tests/integration/ -v
 """
 
 import os
+import time
 
 import pytest
 import requests
@@ -31,6 +32,15 @@ class TestReachability:
         resp = session.get(f"{BASE_URL}/docs")
         assert resp.status_code == 200
 
+    def test_liveness(self, session):
+        resp = session.get(f"{BASE_URL}/healthz")
+        assert resp.status_code == 200
+
+    def test_readiness(self, session):
+        resp = session.get(f"{BASE_URL}/readyz")
+        assert resp.status_code == 200
+        assert resp.json()["status"] == "ready"
+
     def test_openapi_json_available(self, session):
         resp = session.get(f"{BASE_URL}/openapi.json")
         assert resp.status_code == 200
@@ -44,16 +54,25 @@ class TestReachability:
 class TestSync:
     def test_sync_valid_resource_for_fill_data(self, session):
         """
-        Posting with a reachable URL should result in
-        a 200 – confirming the endpoint is up and reachable.
+        Posting with a reachable URL should queue a sync job (202) that
+        finishes successfully – confirming the endpoint is up and reachable.
         """
         resp = session.post(
             f"{BASE_URL}/sync",
             params={"source_url": "rickandmortyapi.com", "resource": "character"},
         )
-        # We expect either an application error or a network error surfaced by
-        # the app, but NOT a 404 for the route itself.
-        assert resp.status_code == 201
+        assert resp.status_code == 202
+
+        job_url = f"{BASE_URL}/sync/{resp.json()['job_id']}"
+        deadline = time.monotonic() + 120
+        while time.monotonic() < deadline:
+            job = session.get(job_url).json()
+            if job["finished_at"]:
+                break
+            time.sleep(1)
+
+        assert job["status"] == "succeeded"
+        assert job["records_synced"] > 0
 
     def test_sync_invalid_resource_still_attempts_request(self, session):
         """
@@ -70,8 +89,8 @@ class TestSync:
 
     def test_rate_limiter_kicks_in(self, session):
         """
-        The endpoint allows 50 requests per 1 seconds; a burst of 100 should
-        trigger at least one 429.
+        A client's bucket holds 50 tokens and /sync costs 10; a burst of 100
+        should trigger at least one 429.
         """
         responses = [
             session.post(
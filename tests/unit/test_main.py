@@ -4,31 +4,37 @@ Unit tests for rickandmorty-api / main.py  (matches updated main.py)
 Run with:  uv run pytest tests/unit/ -v
 """
 
+import asyncio
+import copy
+import gzip
 import json
 import logging
 import pathlib
+import queue
+import re
+import subprocess
 import sys
 import tempfile
-from contextlib import asynccontextmanager
-from unittest.mock import MagicMock, patch
+import threading
+import time
+from contextlib import aclosing, asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock, patch
 
-# ── Provide dummy config files before the module is imported ─────────────────
+import asyncpg
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+# ── Dummy config files, loaded the way create_app() would ────────────────────
 _tmp = pathlib.Path(tempfile.mkdtemp())
 (_tmp / "secrets.json").write_text(
     json.dumps({"user": "u", "password": "p", "host": "localhost", "dbname": "db"})
 )
 (_tmp / "config.yaml").write_text("log_level: INFO\n")
 
-# Patch sys.argv so argparse uses our dummy paths instead of pytest's argv
-sys.argv = [
-    "main.py",
-    "--config",
-    str(_tmp / "config.yaml"),
-    "--secret",
-    str(_tmp / "secrets.json"),
-]
-
-import main  # noqa: E402
+main.load_config(str(_tmp / "config.yaml"), str(_tmp / "secrets.json"))
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Replace lifespan so TestClient never attempts a real DB connection
@@ -41,12 +47,22 @@ async def _noop_lifespan(app):
 
 
 main.app.router.lifespan_context = _noop_lifespan
-
-from fastapi.testclient import TestClient  # noqa: E402
+main.app.state.http_client = MagicMock()
+main.app.state.sync_queue = asyncio.Queue()
 
 client = TestClient(main.app, raise_server_exceptions=False)
 
 
+@pytest.fixture(autouse=True)
+def _empty_response_cache():
+    main.response_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def _full_rate_limit_buckets():
+    main.rate_limiter.store.clear()
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # JsonFormatter
 # ─────────────────────────────────────────────────────────────────────────────
@@ -93,100 +109,570 @@ class TestJsonFormatter:
         )
         assert parsed["logger"] == "mylogger"
 
+    def test_message_is_escaped(self):
+        parsed = json.loads(
+            main.JsonFormatter().format(self._make_record(logging.INFO, 'say "hi"\n\tbye'))
+        )
+        assert parsed["message"] == 'say "hi"\n\tbye'
+
+    def test_request_id_field(self):
+        record = self._make_record(logging.INFO, "")
+        record.request_id = "abc-123"
+
+        parsed = json.loads(main.JsonFormatter().format(record))
+        assert parsed["request_id"] == "abc-123"
+
+    def test_no_request_id_outside_a_request(self):
+        parsed = json.loads(main.JsonFormatter().format(self._make_record(logging.INFO, "")))
+        assert "request_id" not in parsed
+
+    def test_exception_field(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = self._make_record(logging.ERROR, "failed")
+            record.exc_info = sys.exc_info()
+
+        parsed = json.loads(main.JsonFormatter().format(record))
+        assert "ValueError: boom" in parsed["exc"]
+
 
 # ─────────────────────────────────────────────────────────────────────────────
-# rget  — now always returns {"status": bool, "content": ...}, never raises
+# Logging pipeline — queue handoff, correlation ids, sampling
 # ─────────────────────────────────────────────────────────────────────────────
 
 
-class TestRget:
-    @patch("main.requests.get")
-    def test_success_status_true(self, mock_get):
-        import requests as _req
+class TestLogging:
+    def test_prepare_resolves_message_and_request_id(self):
+        handler = main.LogQueueHandler(queue.SimpleQueue())
+        record = logging.LogRecord("test", logging.INFO, "", 0, "page %d", (3,), None)
+
+        token = main.current_request_id.set("req-1")
+        try:
+            handler.handle(record)
+        finally:
+            main.current_request_id.reset(token)
+
+        queued = handler.queue.get_nowait()
+        assert queued.msg == "page 3"
+        assert queued.args is None
+        assert queued.request_id == "req-1"
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = main.LogQueueHandler(queue.SimpleQueue(), max_size=1)
+        before = _sample("rickandmorty_log_records_dropped_total")
+
+        for _ in range(3):
+            handler.handle(logging.LogRecord("test", logging.INFO, "", 0, "x", (), None))
+
+        assert handler.queue.qsize() == 1
+        assert _sample("rickandmorty_log_records_dropped_total") == before + 2
+
+    def test_response_carries_generated_request_id(self):
+        resp = client.get("/healthz")
+
+        assert re.fullmatch(r"[0-9a-f]{32}", resp.headers["x-request-id"])
+
+    def test_client_request_id_is_echoed(self):
+        resp = client.get("/healthz", headers={"X-Request-ID": "trace-42"})
+
+        assert resp.headers["x-request-id"] == "trace-42"
+
+    def test_unsafe_client_request_id_is_replaced(self):
+        resp = client.get("/healthz", headers={"X-Request-ID": 'a" "b'})
+
+        assert resp.headers["x-request-id"] != 'a" "b'
+        assert re.fullmatch(r"[0-9a-f]{32}", resp.headers["x-request-id"])
+
+    def test_success_logs_are_sampled(self, caplog):
+        with patch.dict(main.logging_config, {"success_sample_rate": 0}):
+            with caplog.at_level(logging.INFO, logger="rickandmorty-app"):
+                main.log_success("Sucussfully fetched data")
+
+        assert caplog.records == []
+
+    def test_success_logs_kept_by_default(self, caplog):
+        with caplog.at_level(logging.INFO, logger="rickandmorty-app"):
+            main.log_success("Sucussfully fetched data")
 
-        mock_resp = MagicMock()
-        mock_resp.status_code = _req.codes.ok
-        mock_get.return_value = mock_resp
+        assert [r.levelname for r in caplog.records] == ["INFO"]
 
-        result = main.rget("http://example.com", {})
+    def test_data_success_is_not_logged_as_error(self, caplog):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(1))
+        main.app.state.pool = _pool(mock_conn)
+
+        with caplog.at_level(logging.INFO, logger="rickandmorty-app"):
+            resp = client.get("/data?sort_field=id&sort_order=ASC")
+
+        assert resp.status_code == 200
+        assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# rget  — async, retries 429/5xx, always returns {"status": bool, "content": ...}
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _response(status_code, body=None, headers=None):
+    return httpx.Response(
+        status_code,
+        json=body if body is not None else {},
+        headers=headers,
+        request=httpx.Request("GET", "http://example.com"),
+    )
+
+
+def _client(*responses):
+    mock_client = MagicMock()
+    mock_client.get = AsyncMock(side_effect=list(responses))
+    return mock_client
+
+
+@patch("main.asyncio.sleep", new_callable=AsyncMock)
+class TestRget:
+    async def test_success_status_true(self, _):
+        mock_resp = _response(200)
+
+        result = await main.rget(_client(mock_resp), "http://example.com", {})
 
         assert result["status"] is True
         assert result["content"] is mock_resp
 
-    @patch("main.requests.get")
-    def test_non_ok_status_returns_false(self, mock_get):
-        mock_resp = MagicMock()
-        mock_resp.status_code = 500
-        mock_get.return_value = mock_resp
-
-        result = main.rget("http://example.com", {})
+    async def test_non_ok_status_returns_false(self, _):
+        result = await main.rget(_client(_response(404)), "http://example.com", {})
 
         assert result["status"] is False
         assert result["content"] == "Request status not OK"
 
-    @patch("main.requests.get")
-    def test_http_error_exception_caught(self, mock_get):
-        import requests as _req
+    async def test_server_error_is_retried(self, mock_sleep):
+        mock_client = _client(_response(502), _response(200))
+
+        result = await main.rget(mock_client, "http://example.com", {})
 
-        mock_get.side_effect = _req.exceptions.HTTPError("http error")
+        assert result["status"] is True
+        assert mock_client.get.await_count == 2
+        mock_sleep.assert_awaited_once()
 
-        result = main.rget("http://example.com", {})
+    async def test_429_honours_retry_after(self, mock_sleep):
+        mock_client = _client(_response(429, headers={"Retry-After": "2"}), _response(200))
 
-        assert result["status"] is False
-        assert result["content"] is not None
+        result = await main.rget(mock_client, "http://example.com", {})
 
-    @patch("main.requests.get")
-    def test_connection_error_caught(self, mock_get):
-        import requests as _req
+        assert result["status"] is True
+        mock_sleep.assert_awaited_once_with(2.0)
 
-        mock_get.side_effect = _req.exceptions.ConnectionError("conn refused")
+    async def test_gives_up_after_max_retries(self, mock_sleep):
+        mock_client = _client(*[_response(503)] * 10)
 
-        result = main.rget("http://example.com", {})
+        result = await main.rget(mock_client, "http://example.com", {})
 
         assert result["status"] is False
+        assert mock_client.get.await_count == 4
+        assert mock_sleep.await_count == 3
 
-    @patch("main.requests.get")
-    def test_generic_exception_caught(self, mock_get):
-        mock_get.side_effect = RuntimeError("something exploded")
+    async def test_connection_error_caught(self, _):
+        mock_client = _client(*[httpx.ConnectError("conn refused")] * 4)
 
-        result = main.rget("http://example.com", {})
+        result = await main.rget(mock_client, "http://example.com", {})
 
         assert result["status"] is False
+        assert isinstance(result["content"], httpx.ConnectError)
+
+    async def test_generic_exception_caught(self, _):
+        mock_client = _client(RuntimeError("something exploded"))
 
-    @patch("main.requests.get")
-    def test_timeout_is_passed(self, mock_get):
-        import requests as _req
+        result = await main.rget(mock_client, "http://example.com", {})
 
-        mock_resp = MagicMock()
-        mock_resp.status_code = _req.codes.ok
-        mock_get.return_value = mock_resp
+        assert result["status"] is False
+        assert mock_client.get.await_count == 1
+
+    async def test_params_are_passed(self, _):
+        mock_client = _client(_response(200))
 
-        main.rget("http://example.com", {"k": "v"})
+        await main.rget(mock_client, "http://example.com", {"k": "v"})
 
-        _, kwargs = mock_get.call_args
-        assert kwargs.get("timeout") == (5, 30)
+        _, kwargs = mock_client.get.call_args
+        assert kwargs.get("params") == {"k": "v"}
 
-    @patch("main.requests.get")
-    def test_returns_dict_shape_on_success(self, mock_get):
-        import requests as _req
+    async def test_returns_dict_shape_on_success(self, _):
+        result = await main.rget(_client(_response(200)), "http://example.com", {})
 
-        mock_resp = MagicMock()
-        mock_resp.status_code = _req.codes.ok
-        mock_get.return_value = mock_resp
+        assert set(result.keys()) == {"status", "content"}
 
-        result = main.rget("http://example.com", {})
+    async def test_returns_dict_shape_on_failure(self, _):
+        result = await main.rget(_client(_response(404)), "http://example.com", {})
 
         assert set(result.keys()) == {"status", "content"}
 
-    @patch("main.requests.get")
-    def test_returns_dict_shape_on_failure(self, mock_get):
-        mock_resp = MagicMock()
-        mock_resp.status_code = 404
-        mock_get.return_value = mock_resp
 
-        result = main.rget("http://example.com", {})
+class TestHttpClient:
+    async def test_timeout_is_configured(self):
+        http_client = main.build_http_client()
 
-        assert set(result.keys()) == {"status", "content"}
+        assert http_client.timeout.connect == 5
+        assert http_client.timeout.read == 30
+
+        await http_client.aclose()
+
+    def test_retry_delay_is_capped(self):
+        assert main.retry_delay(0, "3600") == main.upstream_config.get("backoff_max", 10)
+
+    def test_retry_delay_ignores_http_date(self):
+        assert main.retry_delay(0, "Wed, 21 Oct 2015 07:28:00 GMT") <= 0.5
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# fetch_pages — remaining pages fetched concurrently by page number
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _page(page, pages):
+    return _response(
+        200,
+        {
+            "info": {"pages": pages, "count": pages},
+            "results": [{"id": page}],
+        },
+    )
+
+
+class TestFetchPages:
+    async def test_results_keyed_by_page(self):
+        mock_client = _client(_page(2, 3), _page(3, 3))
+
+        result = await main.fetch_pages(mock_client, "http://example.com", {"k": "v"}, [2, 3])
+
+        assert result == {2: [{"id": 2}], 3: [{"id": 3}]}
+
+    async def test_pages_requested_by_number(self):
+        mock_client = _client(_page(2, 3), _page(3, 3))
+
+        await main.fetch_pages(mock_client, "http://example.com", {"k": "v"}, [2, 3])
+
+        _params = [_call.kwargs["params"] for _call in mock_client.get.call_args_list]
+        assert _params == [{"k": "v", "page": 2}, {"k": "v", "page": 3}]
+
+    async def test_failed_page_is_none(self):
+        result = await main.fetch_pages(_client(_response(404)), "http://example.com", {}, [2])
+
+        assert result == {2: None}
+
+    async def test_malformed_page_is_none(self):
+        mock_client = _client(_response(200, {"results": [{"name": "Rick"}]}), _response(200))
+
+        result = await main.fetch_pages(mock_client, "http://example.com", {}, [2, 3])
+
+        assert result == {2: None, 3: None}
+
+    def test_record_hash_ignores_key_order(self):
+        assert main.record_hash({"id": 1, "name": "Rick"}) == main.record_hash(
+            {"name": "Rick", "id": 1}
+        )
+
+    def test_prepare_page_hash_matches_record_hash(self):
+        item = {"name": "Rick", "id": 1}
+
+        assert main.prepare_page([item]) == [(1, '{"id":1,"name":"Rick"}', main.record_hash(item))]
+
+
+class _PagedUpstream:
+    """Answers any page, later pages first when delays say so."""
+
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.requested = []
+
+    async def get(self, url, params=None):
+        self.requested.append(params["page"])
+        await asyncio.sleep(self.delays.get(params["page"], 0))
+        return _page(params["page"], 99)
+
+
+class TestStreamPages:
+    async def test_yields_in_page_order(self):
+        upstream = _PagedUpstream({2: 0.02})
+
+        async with aclosing(main.stream_pages(upstream, "u", {}, [2, 3, 4])) as stream:
+            result = [_results async for _results in stream]
+
+        assert result == [[{"id": 2}], [{"id": 3}], [{"id": 4}]]
+
+    async def test_fetches_at_most_queue_depth_ahead(self):
+        upstream = _PagedUpstream()
+
+        with patch.dict(main.sync_jobs_config, {"queue_depth": 2}):
+            stream = main.stream_pages(upstream, "u", {}, list(range(2, 12)))
+            await anext(stream)
+            await asyncio.sleep(0.01)
+
+            # queue_depth queued, the one consumed and the one waiting for a slot
+            assert len(upstream.requested) <= 4
+
+            assert len([_results async for _results in stream]) == 9
+
+    async def test_closing_cancels_outstanding_fetches(self):
+        upstream = _PagedUpstream({_page: 1 for _page in range(3, 12)})
+
+        stream = main.stream_pages(upstream, "u", {}, list(range(2, 12)))
+        await anext(stream)
+        await stream.aclose()
+        await asyncio.sleep(0)
+
+        assert not [_task for _task in asyncio.all_tasks() if "fetch_page" in repr(_task)]
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# PageCache — raw upstream pages on disk, conditional GETs, replay
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestPageCache:
+    URL = "http://example.com/api/character"
+
+    @pytest.fixture(autouse=True)
+    def page_cache(self, tmp_path):
+        main.page_cache.configure(str(tmp_path))
+        yield main.page_cache
+        main.page_cache.configure()
+
+    def _store(self, page_cache, body, headers=None):
+        page_cache.store(self.URL, {"page": 2}, _response(200, body, headers))
+
+    def test_round_trip_keeps_body_and_validators(self, page_cache):
+        self._store(page_cache, {"results": [{"id": 1}]}, {"ETag": 'W/"abc"'})
+
+        entry = page_cache.load(self.URL, {"page": 2})
+
+        assert json.loads(entry["body"]) == {"results": [{"id": 1}]}
+        assert entry["etag"] == 'W/"abc"'
+        assert page_cache.load(self.URL, {"page": 3}) is None
+
+    def test_unreadable_entry_is_a_miss(self, page_cache):
+        pathlib.Path(page_cache.path(self.URL, {"page": 2})).write_bytes(b"\x00\x00\x00\x02{}junk")
+
+        assert page_cache.load(self.URL, {"page": 2}) is None
+
+    def test_unknown_mode_exits(self):
+        with pytest.raises(SystemExit):
+            main.PageCache(mode="offline")
+
+    async def test_ok_response_is_stored(self, page_cache):
+        await main.rget(_client(_response(200, {"results": []})), self.URL, {"page": 2})
+
+        assert json.loads(page_cache.load(self.URL, {"page": 2})["body"]) == {"results": []}
+
+    async def test_revalidates_and_serves_cached_body_on_304(self, page_cache):
+        self._store(page_cache, {"results": [{"id": 1}]}, {"ETag": 'W/"abc"'})
+        mock_client = _client(_response(304))
+
+        result = await main.rget(mock_client, self.URL, {"page": 2})
+
+        assert mock_client.get.call_args.kwargs["headers"] == {"If-None-Match": 'W/"abc"'}
+        assert result["status"] is True
+        assert result["content"].json() == {"results": [{"id": 1}]}
+
+    async def test_no_validators_no_conditional_request(self, page_cache):
+        self._store(page_cache, {"results": []})
+        mock_client = _client(_response(200, {"results": []}))
+
+        await main.rget(mock_client, self.URL, {"page": 2})
+
+        assert "headers" not in mock_client.get.call_args.kwargs
+
+    async def test_replay_never_calls_upstream(self, page_cache):
+        self._store(page_cache, {"results": [{"id": 1}]})
+        page_cache.mode = "replay"
+        mock_client = _client()
+
+        hit = await main.rget(mock_client, self.URL, {"page": 2})
+        miss = await main.rget(mock_client, self.URL, {"page": 3})
+
+        assert hit["content"].json() == {"results": [{"id": 1}]}
+        assert miss == {"status": False, "content": "Page not in replay snapshot"}
+        mock_client.get.assert_not_awaited()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# /stats — aggregates from the character_stats materialized view
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestStats:
+    def _stats_conn(self, total, *rows):
+        mock_conn = MagicMock()
+        mock_conn.fetchval = AsyncMock(return_value=total)
+        mock_conn.fetch = AsyncMock(
+            return_value=[
+                {"dimension": _dimension, "value": _value, "count": _count}
+                for _dimension, _value, _count in rows
+            ]
+        )
+        main.app.state.pool = _pool(mock_conn)
+        return mock_conn
+
+    def test_counts_grouped_by_dimension(self):
+        self._stats_conn(3, ("gender", "Male", 3), ("status", "Alive", 2), ("status", "Dead", 1))
+
+        resp = client.get("/stats")
+
+        assert resp.status_code == 200
+        assert resp.json() == {
+            "total": 3,
+            "status": {"Alive": 2, "Dead": 1},
+            "species": {},
+            "gender": {"Male": 3},
+            "origin": {},
+            "location": {},
+        }
+
+    def test_dimension_and_limit_reach_the_query(self):
+        mock_conn = self._stats_conn(3, ("species", "Human", 3))
+
+        resp = client.get("/stats?dimension=species&dimension=origin&limit=5")
+
+        assert resp.json() == {"total": 3, "species": {"Human": 3}, "origin": {}}
+        assert mock_conn.fetch.call_args.args[1:] == (["species", "origin"], 5)
+
+    def test_unknown_dimension_returns_400(self):
+        resp = client.get("/stats?dimension=name")
+
+        assert resp.status_code == 400
+        assert "status, species" in resp.json()["detail"]
+
+    def test_cached_until_stats_version_changes(self):
+        mock_conn = self._stats_conn(1, ("status", "Alive", 1))
+
+        with patch.dict(main.table_versions, {main.STATS_VIEW: 1}):
+            first = client.get("/stats")
+            client.get("/stats")
+            assert mock_conn.fetch.await_count == 1
+
+            main.apply_table_version(main.STATS_VIEW, 2)
+            second = client.get("/stats")
+            assert mock_conn.fetch.await_count == 2
+
+            # Tags follow the view version, not the body
+            stale = client.get("/stats", headers={"If-None-Match": first.headers["ETag"]})
+            assert stale.status_code == 200
+            again = client.get("/stats", headers={"If-None-Match": second.headers["ETag"]})
+            assert again.status_code == 304
+
+    async def test_refresh_bumps_stats_version(self):
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock()
+        mock_conn.fetchval = AsyncMock(return_value=4)
+
+        with patch.dict(main.table_versions, {main.STATS_VIEW: 3}):
+            await main.refresh_stats(mock_conn)
+            assert main.table_versions[main.STATS_VIEW] == 4
+
+        mock_conn.execute.assert_any_await("REFRESH MATERIALIZED VIEW CONCURRENTLY character_stats")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# /search — ranked name search
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestSearch:
+    def _search_conn(self, *ids):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(*ids))
+        main.app.state.pool = _pool(mock_conn)
+        return mock_conn
+
+    def test_fulltext_matches_word_prefixes(self):
+        mock_conn = self._search_conn(1, 2)
+
+        resp = client.get("/search?q=Rick  San-chez")
+
+        assert resp.status_code == 200
+        assert resp.json() == [{"id": 1}, {"id": 2}]
+        query, *args = mock_conn.fetch.call_args.args
+        assert "to_tsquery('simple', $1)" in query
+        assert args == ["rick:* & san:* & chez:*", 20, 0]
+
+    def test_trigram_passes_query_through(self):
+        mock_conn = self._search_conn(1)
+
+        with patch.dict(main.search_state, {"backend": "trigram"}):
+            client.get("/search?q=Rik Sanch&limit=5&offset=10")
+
+        query, *args = mock_conn.fetch.call_args.args
+        assert "$1 <% (data->>'name')" in query
+        assert "word_similarity" in query
+        assert args == ["Rik Sanch", 5, 10]
+
+    def test_no_words_skips_the_db(self):
+        mock_conn = self._search_conn(1)
+
+        resp = client.get("/search?q=%25%26!")
+
+        assert resp.json() == []
+        mock_conn.fetch.assert_not_awaited()
+
+    def test_full_page_carries_next_offset(self):
+        self._search_conn(1, 2)
+
+        full = client.get("/search?q=rick&limit=2&offset=4")
+        short = client.get("/search?q=rick&limit=3")
+
+        assert full.headers["X-Next-Offset"] == "6"
+        assert "X-Next-Offset" not in short.headers
+
+    def test_fields_projected(self):
+        mock_conn = self._search_conn(1)
+
+        client.get("/search?q=rick&fields=id,name")
+
+        assert (
+            "jsonb_build_object('id', data->'id', 'name', data->'name')"
+            in (mock_conn.fetch.call_args.args[0])
+        )
+
+    def test_cached_and_tagged(self):
+        mock_conn = self._search_conn(1)
+
+        first = client.get("/search?q=rick")
+        again = client.get("/search?q=rick", headers={"If-None-Match": first.headers["ETag"]})
+        client.get("/search?q=rick")
+
+        assert again.status_code == 304
+        assert mock_conn.fetch.await_count == 1
+
+    @pytest.mark.parametrize(
+        "query", ["", "q=", f"q={'x' * 101}", "q=rick&limit=0", "q=rick&offset=1001"]
+    )
+    def test_invalid_parameters_return_422(self, query):
+        assert client.get(f"/search?{query}").status_code == 422
+
+    def test_unknown_field_returns_400(self):
+        assert client.get("/search?q=rick&fields=password").status_code == 400
+
+    async def test_schema_prefers_trigram(self):
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock()
+
+        with patch.dict(main.search_state):
+            await main.ensure_schema(mock_conn)
+            assert main.search_state["backend"] == "trigram"
+
+        mock_conn.execute.assert_any_await("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    async def test_schema_falls_back_without_pg_trgm(self):
+        async def _execute(statement):
+            if "pg_trgm" in statement:
+                raise asyncpg.UndefinedFileError("extension is not available")
+
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock(side_effect=_execute)
+
+        with patch.dict(main.search_state, {"backend": "trigram"}):
+            await main.ensure_schema(mock_conn)
+            assert main.search_state["backend"] == "fulltext"
+
+        assert "to_tsvector" in mock_conn.execute.call_args.args[0]
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -228,37 +714,1600 @@ class TestGetDataValidation:
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# /db-mon — input validation (no DB needed)
+# /data?stream=true — server-side cursor, JSON array or NDJSON
 # ─────────────────────────────────────────────────────────────────────────────
 
 
-class TestDbMonValidation:
-    def test_unknown_aspect_returns_400(self):
-        resp = client.get("/db-mon?aspect=garbage")
-        assert resp.status_code == 400
-        assert "Unrecognized aspect" in resp.json()["detail"]
+def _cursor_conn(*chunks):
+    mock_cursor = MagicMock()
+    mock_cursor.fetch = AsyncMock(side_effect=[*chunks, []])
+    mock_conn = MagicMock()
+    mock_conn.cursor = AsyncMock(return_value=mock_cursor)
+    return mock_conn
 
-    def test_missing_aspect_returns_422(self):
-        resp = client.get("/db-mon")
-        assert resp.status_code == 422
 
-    def test_injection_attempt_rejected(self):
-        resp = client.get("/db-mon?aspect=conn; DROP TABLE character;--")
-        assert resp.status_code == 400
+def _rows(*ids):
+    return [{"id": _id, "data": json.dumps({"id": _id})} for _id in ids]
+
+
+class TestGetDataStream:
+    def test_json_array_across_chunks(self):
+        main.app.state.pool = _pool(_cursor_conn(_rows(1, 2), _rows(3)))
+
+        resp = client.get("/data?sort_field=id&sort_order=ASC&stream=true")
+
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/json"
+        assert [_item["id"] for _item in resp.json()] == [1, 2, 3]
+
+    def test_empty_table_is_empty_array(self):
+        main.app.state.pool = _pool(_cursor_conn())
+
+        resp = client.get("/data?sort_field=id&sort_order=ASC&stream=true")
+
+        assert resp.json() == []
+
+    def test_ndjson_selected_by_accept(self):
+        main.app.state.pool = _pool(_cursor_conn(_rows(1, 2), _rows(3)))
+
+        resp = client.get(
+            "/data?sort_field=id&sort_order=DESC&stream=true",
+            headers={"Accept": "application/x-ndjson"},
+        )
+
+        assert resp.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(_line)["id"] for _line in resp.text.splitlines()] == [1, 2, 3]
+
+    def test_connection_released_after_stream(self):
+        main.app.state.pool = _pool(_cursor_conn(_rows(1)))
+
+        client.get("/data?sort_field=id&sort_order=ASC&stream=true")
+
+        main.app.state.pool.release.assert_awaited_once()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
-# /sync — route wiring & rget failure handling (no network, no DB)
+# /export — COPY … TO STDOUT streamed as NDJSON or CSV
 # ─────────────────────────────────────────────────────────────────────────────
 
 
-class TestSyncRoute:
-    def test_missing_params_returns_422(self):
-        resp = client.post("/sync")
-        assert resp.status_code == 422
+def _copy_conn(*chunks, error=None):
+    mock_conn = MagicMock()
+    mock_conn.progress = 0
 
-    @patch("main.rget", return_value={"status": False, "content": "connection error"})
-    def test_failed_rget_handled_gracefully(self, _):
-        """When rget returns status=False the while loop exits; endpoint should not 500."""
-        resp = client.post("/sync?source_url=unreachable.invalid&resource=character")
-        assert resp.status_code < 500
+    async def _copy(query, *args, output, **options):
+        for _chunk in chunks:
+            await output(bytearray(_chunk))
+            mock_conn.progress += 1
+        if error is not None:
+            raise error
+
+    mock_conn.copy_from_query = AsyncMock(side_effect=_copy)
+    return mock_conn
+
+
+class TestExport:
+    def test_ndjson_passes_copy_output_through(self):
+        mock_conn = _copy_conn(b'{"id": 1}\n{"id": 2}\n', b'{"id": 3}\n')
+        main.app.state.pool = _pool(mock_conn)
+
+        resp = client.get("/export")
+
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/x-ndjson"
+        assert resp.headers["content-disposition"] == 'attachment; filename="character.ndjson"'
+        assert [json.loads(_line)["id"] for _line in resp.text.splitlines()] == [1, 2, 3]
+        assert mock_conn.copy_from_query.call_args.kwargs["quote"] == "\x01"
+        main.app.state.pool.release.assert_awaited_once()
+
+    def test_csv_has_one_column_per_field(self):
+        mock_conn = _copy_conn(b"id,name\n1,Rick\n")
+        main.app.state.pool = _pool(mock_conn)
+
+        resp = client.get("/export?format=csv&fields=id,name&status=Alive")
+
+        query, *args = mock_conn.copy_from_query.call_args.args
+        assert resp.headers["content-type"].startswith("text/csv")
+        assert query == (
+            "SELECT data->>'id' AS \"id\", data->>'name' AS \"name\" FROM character "
+            "WHERE data @> $1::jsonb ORDER BY id"
+        )
+        assert args == [json.dumps({"status": "Alive"})]
+        assert mock_conn.copy_from_query.call_args.kwargs["header"] is True
+
+    @pytest.mark.parametrize("query", ["format=xml", "fields=id,secret"])
+    def test_invalid_parameters_return_400(self, query):
+        assert client.get(f"/export?{query}").status_code == 400
+
+    async def test_small_chunks_sent_in_larger_writes(self):
+        main.app.state.pool = _pool(_copy_conn(b"a\n", b"b\n", b"c\n"))
+
+        with patch.dict(main.data_config, {"export_chunk_size": 4}):
+            chunks = [_chunk async for _chunk in main.stream_copy("SELECT 1", [], "ndjson")]
+
+        assert chunks == [b"a\nb\n", b"c\n"]
+
+    def test_error_mid_copy_truncates_body(self):
+        error = asyncpg.exceptions.QueryCanceledError("canceling statement")
+        main.app.state.pool = _pool(_copy_conn(b'{"id": 1}\n', error=error))
+
+        resp = client.get("/export")
+
+        assert resp.status_code == 200
+        assert resp.text == '{"id": 1}\n'
+        main.app.state.pool.release.assert_awaited_once()
+
+    async def test_copy_waits_for_a_slow_client(self):
+        mock_conn = _copy_conn(*[b"x\n"] * 10)
+        main.app.state.pool = _pool(mock_conn)
+
+        with patch.dict(main.data_config, {"export_buffer_chunks": 2, "export_chunk_size": 1}):
+            stream = main.stream_copy("SELECT 1", [], "ndjson")
+            await anext(stream)
+            await asyncio.sleep(0.01)
+
+            assert mock_conn.progress <= 4
+
+            await stream.aclose()
+            await asyncio.sleep(0.01)
+
+        main.app.state.pool.release.assert_awaited_once()
+        assert mock_conn.progress < 10
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Serialization — JSONB passthrough & FastJSONResponse
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestSerialization:
+    def test_data_rows_are_objects_not_strings(self):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(
+            return_value=[{"id": 1, "data": '{"id": 1, "name": "Rick \\u00e9"}'}]
+        )
+        main.app.state.pool = _pool(mock_conn)
+
+        resp = client.get("/data?sort_field=id&sort_order=ASC")
+
+        assert resp.json() == [{"id": 1, "name": "Rick \u00e9"}]
+
+    def test_data_body_is_spliced_not_reencoded(self):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(1, 2))
+        main.app.state.pool = _pool(mock_conn)
+
+        with patch("main.json.dumps", side_effect=AssertionError("re-encoded")):
+            resp = client.get("/data?sort_field=id&sort_order=ASC")
+
+        assert resp.content == b'[{"id": 1},{"id": 2}]'
+
+    def test_raw_json_array_empty(self):
+        assert main.raw_json_array([]) == b"[]"
+
+    def test_fast_response_matches_stdlib_encoding(self):
+        content = {"job": "a", "counts": [1, 2.5, None], "ok": True, "name": "Morty"}
+
+        assert json.loads(main.FastJSONResponse(content=content).body) == content
+
+    def test_fast_response_without_orjson(self):
+        with patch.object(main, "orjson", None):
+            body = main.FastJSONResponse(content={"a": 1}).body
+
+        assert body == b'{"a":1}'
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# /data keyset pagination & field projection
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestDataQuery:
+    def test_plain_query_unchanged(self):
+        query, args = main.build_data_query("id", "ASC")
+        assert query.split() == "SELECT id, data FROM character ORDER BY character.id ASC".split()
+        assert args == []
+
+    def test_keyset_on_id_uses_primary_key(self):
+        query, args = main.build_data_query("id", "DESC", limit=10, after_id=42)
+        assert "WHERE id < $1" in query
+        assert query.endswith("LIMIT $2")
+        assert args == [42, 10]
+
+    def test_keyset_on_data_breaks_ties_by_id(self):
+        query, _ = main.build_data_query("data", "ASC", limit=10, after_id=42)
+        assert "(data, id) > (SELECT data, id FROM character WHERE id = $1)" in query
+        assert "ORDER BY character.data ASC, id ASC" in query
+
+    def test_projection_does_not_change_keyset_ordering(self):
+        query, _ = main.build_data_query(
+            "data", "DESC", limit=10, after_id=42, fields=["name", "status"]
+        )
+        assert "AS data" in query
+        assert "(data, id) < (SELECT data, id FROM character WHERE id = $1)" in query
+        assert "ORDER BY character.data DESC, id DESC" in query
+
+    def test_projection_builds_object(self):
+        query, _ = main.build_data_query("id", "ASC", fields=["name", "status"])
+        assert "jsonb_build_object('name', data->'name', 'status', data->'status')" in query
+
+    def test_filters_compile_to_single_containment(self):
+        query, args = main.build_data_query(
+            "id", "ASC", filters={"status": "Dead", "origin": "Citadel of Ricks", "gender": None}
+        )
+        assert "WHERE data @> $1::jsonb ORDER BY" in query
+        assert json.loads(args[0]) == {"status": "Dead", "origin": {"name": "Citadel of Ricks"}}
+
+    def test_name_prefix_escapes_like_wildcards(self):
+        query, args = main.build_data_query("id", "ASC", filters={"name": "50%_Rick"})
+        assert "data->>'name' LIKE $1" in query
+        assert args == ["50\\%\\_Rick%"]
+
+    def test_filters_combine_with_keyset(self):
+        query, args = main.build_data_query(
+            "id", "ASC", limit=5, after_id=9, filters={"species": "Human", "name": "Ri"}
+        )
+        assert "WHERE data @> $1::jsonb AND data->>'name' LIKE $2 AND id > $3" in query
+        assert args[2:] == [9, 5]
+
+    def test_cursor_roundtrip(self):
+        after = main.encode_cursor("id", "ASC", 20)
+        assert main.decode_cursor(after, "id", "ASC") == 20
+
+
+class TestDataPagination:
+    def _conn(self, *ids):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(*ids))
+        return mock_conn
+
+    def test_full_page_returns_next_cursor(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        resp = client.get("/data?sort_field=id&sort_order=ASC&limit=2")
+
+        assert resp.status_code == 200
+        assert main.decode_cursor(resp.headers["X-Next-Cursor"], "id", "ASC") == 2
+
+    def test_last_page_has_no_cursor(self):
+        main.app.state.pool = _pool(self._conn(3))
+
+        resp = client.get("/data?sort_field=id&sort_order=ASC&limit=2")
+
+        assert "X-Next-Cursor" not in resp.headers
+
+    def test_cursor_passed_as_query_arg(self):
+        mock_conn = self._conn()
+        main.app.state.pool = _pool(mock_conn)
+        after = main.encode_cursor("id", "ASC", 7)
+
+        client.get(f"/data?sort_field=id&sort_order=asc&limit=5&after={after}")
+
+        assert mock_conn.fetch.call_args.args[1:] == (7, 5)
+
+    def test_garbage_cursor_returns_400(self):
+        resp = client.get("/data?sort_field=id&sort_order=ASC&after=not-a-cursor")
+        assert resp.status_code == 400
+        assert "Invalid cursor" in resp.json()["detail"]
+
+    def test_cursor_from_other_ordering_returns_400(self):
+        after = main.encode_cursor("id", "DESC", 7)
+        resp = client.get(f"/data?sort_field=id&sort_order=ASC&after={after}")
+        assert resp.status_code == 400
+
+    def test_cursor_id_outside_int4_returns_400(self):
+        for last_id in (2**31, -(2**31) - 1):
+            after = main.encode_cursor("id", "ASC", last_id)
+            resp = client.get(f"/data?sort_field=id&sort_order=ASC&after={after}")
+            assert resp.status_code == 400
+            assert resp.json()["detail"] == "Invalid cursor"
+
+        assert (
+            main.decode_cursor(main.encode_cursor("id", "ASC", 2**31 - 1), "id", "ASC") == 2**31 - 1
+        )
+
+    def test_unknown_field_returns_400(self):
+        resp = client.get("/data?sort_field=id&sort_order=ASC&fields=name,password")
+        assert resp.status_code == 400
+        assert "password" in resp.json()["detail"]
+
+    def test_status_filter_passed_to_query(self):
+        mock_conn = self._conn()
+        main.app.state.pool = _pool(mock_conn)
+
+        client.get("/data?sort_field=id&sort_order=ASC&status=Dead&location=Earth")
+
+        assert json.loads(mock_conn.fetch.call_args.args[1]) == {
+            "status": "Dead",
+            "location": {"name": "Earth"},
+        }
+
+    def test_limit_out_of_range_returns_422(self):
+        resp = client.get("/data?sort_field=id&sort_order=ASC&limit=0")
+        assert resp.status_code == 422
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Response cache
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestResponseCache:
+    URL = "/data?sort_field=id&sort_order=ASC&limit=2"
+
+    def _conn(self, *ids):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(*ids))
+        return mock_conn
+
+    def test_repeat_request_served_from_cache(self):
+        mock_conn = self._conn(1, 2)
+        main.app.state.pool = _pool(mock_conn)
+
+        first = client.get(self.URL)
+        second = client.get(self.URL)
+
+        assert mock_conn.fetch.await_count == 1
+        assert second.content == first.content
+        assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+
+    def test_if_none_match_returns_304(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        etag = client.get(self.URL).headers["ETag"]
+        resp = client.get(self.URL, headers={"If-None-Match": f'"other", {etag}'})
+
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.content == b""
+
+    def test_stale_etag_returns_body(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        resp = client.get(self.URL, headers={"If-None-Match": '"stale"'})
+
+        assert resp.status_code == 200
+        assert len(resp.json()) == 2
+
+    def test_table_version_bump_invalidates(self):
+        mock_conn = self._conn(1, 2)
+        main.app.state.pool = _pool(mock_conn)
+
+        client.get(self.URL)
+        with patch.dict(main.table_versions, {"character": main.table_versions["character"] + 1}):
+            client.get(self.URL)
+
+        assert mock_conn.fetch.await_count == 2
+
+    def test_lru_eviction_by_entries(self):
+        cache = main.ResponseCache(max_entries=2)
+
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.get("a")
+        cache.put("c", b"3")
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_eviction_by_bytes(self):
+        cache = main.ResponseCache(max_bytes=10)
+
+        cache.put("a", b"x" * 6)
+        cache.put("b", b"y" * 6)
+
+        assert cache.get("a") is None
+        assert cache.stats()["bytes"] == 6
+
+    def test_oversized_body_not_stored(self):
+        cache = main.ResponseCache(max_bytes=4)
+
+        entry = cache.put("a", b"too large")
+
+        assert entry["body"] == b"too large"
+        assert cache.stats()["entries"] == 0
+
+    def test_expired_entry_is_a_miss(self):
+        cache = main.ResponseCache(ttl=10)
+
+        with patch("main.time.monotonic", return_value=100.0):
+            cache.put("a", b"1")
+        with patch("main.time.monotonic", return_value=111.0):
+            assert cache.get("a") is None
+
+        assert cache.stats() == {
+            "entries": 0,
+            "bytes": 0,
+            "hits": 0,
+            "misses": 1,
+            "evictions": 0,
+            "hit_rate": 0.0,
+        }
+
+    def test_db_mon_cache_aspect(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+        client.get(self.URL)
+        client.get(self.URL)
+
+        resp = client.get("/db-mon?aspect=cache")
+
+        assert resp.status_code == 200
+        assert resp.json()["hits"] >= 1
+        assert resp.json()["entries"] == 1
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Compression and conditional requests
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestCompression:
+    URL = "/data?sort_field=id&sort_order=ASC&limit=2"
+
+    def _conn(self, *ids):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(*ids))
+        return mock_conn
+
+    @pytest.mark.parametrize(
+        "accept_encoding, expected",
+        [
+            (None, None),
+            ("gzip", "gzip"),
+            ("gzip, deflate, br, zstd", "zstd"),
+            ("gzip;q=0.5, br", "br"),
+            ("zstd;q=0, br;q=0, gzip", "gzip"),
+            ("*", "zstd"),
+            ("*, zstd;q=0", "br"),
+            ("identity", None),
+            ("gzip;q=0", None),
+        ],
+    )
+    def test_negotiate_encoding(self, accept_encoding, expected):
+        with patch.dict(main.ENCODERS, {"br": lambda body: body, "zstd": lambda body: body}):
+            assert main.negotiate_encoding(accept_encoding) == expected
+
+    def test_negotiate_skips_unavailable_encoders(self):
+        with patch.dict(main.ENCODERS, clear=True):
+            main.ENCODERS["gzip"] = lambda body: body
+            assert main.negotiate_encoding("zstd, br, gzip") == "gzip"
+
+    def test_gzip_above_min_size(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        with patch.dict(main.compression_config, {"min_size": 0}):
+            resp = client.get(self.URL, headers={"Accept-Encoding": "gzip"})
+
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.headers["Vary"] == "Accept-Encoding"
+        assert resp.headers["ETag"].endswith('-gzip"')
+        assert len(resp.json()) == 2
+
+    def test_small_body_not_compressed(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        with patch.dict(main.compression_config, {"min_size": 1 << 20}):
+            resp = client.get(self.URL, headers={"Accept-Encoding": "gzip"})
+
+        assert "Content-Encoding" not in resp.headers
+        assert resp.headers["Vary"] == "Accept-Encoding"
+
+    def test_variant_compressed_once_and_counted(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+        encoder = MagicMock(side_effect=gzip.compress)
+
+        with (
+            patch.dict(main.compression_config, {"min_size": 0}),
+            patch.dict(main.ENCODERS, {"gzip": encoder}),
+        ):
+            first = client.get(self.URL, headers={"Accept-Encoding": "gzip"})
+            second = client.get(self.URL, headers={"Accept-Encoding": "gzip"})
+
+        encoder.assert_called_once()
+        assert first.content == second.content
+        body = encoder.call_args.args[0]
+        assert main.response_cache.stats()["bytes"] == len(body) + len(gzip.compress(body))
+
+    def test_large_body_compressed_in_thread(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        with (
+            patch.dict(main.compression_config, {"min_size": 0, "offload_size": 0}),
+            patch("main.asyncio.to_thread", AsyncMock(return_value=b"z")) as to_thread,
+        ):
+            client.get(self.URL, headers={"Accept-Encoding": "gzip"})
+
+        assert to_thread.await_args.args[0] is main.ENCODERS["gzip"]
+
+    def test_304_without_touching_db(self):
+        mock_conn = self._conn(1, 2)
+        main.app.state.pool = _pool(mock_conn)
+        etag = client.get(self.URL).headers["ETag"]
+        main.response_cache.clear()
+
+        resp = client.get(self.URL, headers={"If-None-Match": etag})
+
+        assert resp.status_code == 304
+        assert resp.headers["Vary"] == "Accept-Encoding"
+        assert mock_conn.fetch.await_count == 1
+
+    def test_304_for_compressed_variant_tag(self):
+        main.app.state.pool = _pool(self._conn(1, 2))
+
+        with patch.dict(main.compression_config, {"min_size": 0}):
+            etag = client.get(self.URL, headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+            resp = client.get(self.URL, headers={"If-None-Match": f"W/{etag}"})
+
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+
+    def test_etag_stable_across_processes(self):
+        key = ("SELECT 1", 2, 3)
+
+        assert main.version_etag(key) == main.version_etag(("SELECT 1", 2, 3))
+        assert main.version_etag(key) != main.version_etag(("SELECT 1", 2, 4))
+
+    def test_add_variant_after_eviction_not_counted(self):
+        cache = main.ResponseCache(max_entries=1)
+        entry = cache.put("a", b"body")
+        cache.put("b", b"other")
+
+        cache.add_variant("a", entry, "gzip", b"zz")
+
+        assert entry["variants"] == {"gzip": b"zz"}
+        assert cache.stats()["bytes"] == len(b"other")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# /db-mon — input validation (no DB needed)
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestDbMonValidation:
+    def test_unknown_aspect_returns_400(self):
+        resp = client.get("/db-mon?aspect=garbage")
+        assert resp.status_code == 400
+        assert "Unrecognized aspect" in resp.json()["detail"]
+
+    def test_missing_aspect_returns_422(self):
+        resp = client.get("/db-mon")
+        assert resp.status_code == 422
+
+    def test_injection_attempt_rejected(self):
+        resp = client.get("/db-mon?aspect=conn; DROP TABLE character;--")
+        assert resp.status_code == 400
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Application pool — db_acquire() wait accounting & /db-mon?aspect=pool
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _pool(conn=None, acquire_side_effect=None):
+    mock_pool = MagicMock()
+    mock_pool.acquire = AsyncMock(return_value=conn, side_effect=acquire_side_effect)
+    mock_pool.release = AsyncMock()
+    mock_pool.get_size.return_value = 4
+    mock_pool.get_idle_size.return_value = 1
+    mock_pool.get_min_size.return_value = 2
+    mock_pool.get_max_size.return_value = 5
+    return mock_pool
+
+
+class TestDbPool:
+    async def test_acquire_releases_connection(self):
+        mock_conn = MagicMock()
+        main.app.state.pool = _pool(mock_conn)
+
+        async with main.db_acquire() as _conn:
+            assert _conn is mock_conn
+
+        main.app.state.pool.release.assert_awaited_once_with(mock_conn)
+
+    async def test_acquire_records_wait(self):
+        main.app.state.pool = _pool(MagicMock())
+        _before = main.pool_stats["acquired"]
+
+        async with main.db_acquire():
+            pass
+
+        assert main.pool_stats["acquired"] == _before + 1
+        assert main.pool_stats["waiting"] == 0
+
+    async def test_acquire_timeout_returns_503(self):
+        from fastapi import HTTPException
+
+        main.app.state.pool = _pool(acquire_side_effect=TimeoutError())
+
+        try:
+            async with main.db_acquire():
+                raise AssertionError("should not acquire")
+        except HTTPException as _err:
+            assert _err.status_code == 503
+
+        assert main.pool_stats["waiting"] == 0
+
+    def test_pool_aspect_reports_saturation(self):
+        main.app.state.pool = _pool(MagicMock())
+
+        resp = client.get("/db-mon?aspect=pool")
+
+        assert resp.status_code == 200
+        body = resp.json()
+        assert body["in_use"] == 3
+        assert body["max_size"] == 5
+        assert {"waiting", "wait_seconds_avg", "wait_seconds_max"} <= body.keys()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Health — background samples, probes, approximate/exact counts
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestHealth:
+    @pytest.fixture(autouse=True)
+    def _health_state(self):
+        saved = copy.deepcopy(main.health_state)
+        yield
+        main.health_state.clear()
+        main.health_state.update(saved)
+
+    def _conn(self, rows=(), error=None):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=list(rows), side_effect=error)
+        mock_conn.fetchval = AsyncMock(return_value=42)
+        return mock_conn
+
+    async def test_sample_uses_statistics_not_count(self):
+        mock_conn = self._conn([{"relname": "character", "n": 812}])
+        main.app.state.pool = _pool(mock_conn)
+
+        await main.sample_health()
+
+        assert main.health_is_ready()
+        assert main.health_state["counts"]["character"]["approximate"] == 812
+        assert "count(" not in mock_conn.fetch.call_args.args[0].lower()
+
+    async def test_db_error_marks_not_ready(self):
+        main.app.state.pool = _pool(self._conn(error=OSError("connection refused")))
+
+        await main.sample_health()
+
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        assert "connection refused" in resp.json()["error"]
+
+    async def test_pool_exhaustion_keeps_previous_verdict(self):
+        main.app.state.pool = _pool(self._conn())
+        await main.sample_health()
+        main.app.state.pool = _pool(acquire_side_effect=TimeoutError())
+
+        await main.sample_health()
+
+        assert main.health_is_ready()
+        assert main.health_state["error"] == "Database pool exhausted"
+
+    def test_stale_sample_is_not_ready(self):
+        main.health_state.update(ready=True, checked_at=time.time() - 3600)
+
+        assert client.get("/readyz").status_code == 503
+        assert client.get("/db-mon?aspect=conn").status_code == 500
+
+    def test_liveness_needs_no_database(self):
+        main.app.state.pool = _pool(acquire_side_effect=AssertionError("no DB on liveness"))
+
+        resp = client.get("/healthz")
+
+        assert resp.status_code == 200
+
+    def test_records_served_from_sample(self):
+        main.app.state.pool = _pool(acquire_side_effect=AssertionError("no DB on records"))
+        main.health_state["counts"]["character"]["approximate"] = 810
+
+        body = client.get("/db-mon?aspect=records").json()
+
+        assert body["records"] == 810
+        assert body["estimated"] is True
+
+    async def test_exact_count_preferred_once_refreshed(self):
+        main.app.state.pool = _pool(self._conn())
+
+        await main.refresh_exact_counts()
+        body = client.get("/db-mon?aspect=records").json()
+
+        assert body["records"] == 42
+        assert body["estimated"] is False
+        assert body["exact_at"] is not None
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# /sync — route wiring & rget failure handling (no network, no DB)
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestSyncRoute:
+    def test_missing_params_returns_422(self):
+        resp = client.post("/sync")
+        assert resp.status_code == 422
+
+    @patch(
+        "main.rget",
+        new_callable=AsyncMock,
+        return_value={"status": False, "content": "connection error"},
+    )
+    def test_failed_rget_handled_gracefully(self, _):
+        """When rget returns status=False the while loop exits; endpoint should not 500."""
+        resp = client.post("/sync?source_url=unreachable.invalid&resource=character")
+        assert resp.status_code < 500
+
+    def _sync_conn(self, state=None):
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock()
+        mock_conn.fetch = AsyncMock(return_value=[])
+        mock_conn.copy_records_to_table = AsyncMock()
+        mock_conn.fetchrow = AsyncMock(
+            side_effect=[state, {"inserted": 1, "updated": 1, "total": 3}]
+        )
+        mock_conn.fetchval = AsyncMock(return_value=7)
+        return mock_conn
+
+    def test_invalid_mode_returns_400(self):
+        resp = client.post("/sync?source_url=example.com&resource=character&mode=fast")
+        assert resp.status_code == 400
+
+    @patch("main.rget", new_callable=AsyncMock)
+    async def test_sync_copies_and_reports_counts(self, mock_rget):
+        mock_rget.return_value = {
+            "status": True,
+            "content": _response(
+                200,
+                {"info": {"pages": 1, "count": 3}, "results": [{"id": 1}, {"id": 2}, {"id": 3}]},
+            ),
+        }
+        mock_conn = self._sync_conn()
+        main.app.state.pool = _pool(mock_conn)
+
+        with patch.dict(main.table_versions, {"character": 0}):
+            result = await main.sync_resource("example.com", "character", {}, "full")
+            assert main.table_versions["character"] == 7
+
+        mock_conn.execute.assert_any_await(
+            "SELECT pg_notify($1, $2)",
+            main.VERSION_CHANNEL,
+            json.dumps({"table": "character", "version": 7}),
+        )
+
+        assert result["content"] == {
+            "records_synced": 3,
+            "pages_fetched": 1,
+            "pages_skipped": 0,
+            "inserted": 1,
+            "updated": 1,
+            "unchanged": 1,
+        }
+        _, kwargs = mock_conn.copy_records_to_table.call_args
+        assert [_id for _id, _ in kwargs["records"]] == [1, 2, 3]
+
+    @patch("main.rget", new_callable=AsyncMock)
+    async def test_upstream_scheme_is_configurable(self, mock_rget):
+        mock_rget.return_value = {"status": False, "content": "Request status not OK"}
+
+        await main.sync_resource("example.com", "character", {}, "full")
+        assert mock_rget.call_args.args[1] == "https://example.com/api/character"
+
+        with patch.dict(main.upstream_config, {"scheme": "http"}):
+            await main.sync_resource("127.0.0.1:8801", "character", {}, "full")
+        assert mock_rget.call_args.args[1] == "http://127.0.0.1:8801/api/character"
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Table versions — NOTIFY-driven cache invalidation across replicas
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestTableVersions:
+    def test_notify_applies_newer_version_and_drops_that_tables_pages(self):
+        main.response_cache.put("key", b"[]", table="character")
+        main.response_cache.put("stats", b"{}", table=main.STATS_VIEW)
+
+        with patch.dict(main.table_versions, {"character": 3}):
+            main.on_version_notify(
+                None, 1, main.VERSION_CHANNEL, '{"table": "character", "version": 4}'
+            )
+            assert main.table_versions["character"] == 4
+
+        assert main.response_cache.get("key") is None
+        # Other tables' pages are still current
+        assert main.response_cache.get("stats") is not None
+        assert main.response_cache.stats()["bytes"] == 2
+
+    def test_notify_ignores_older_version(self):
+        main.response_cache.put("key", b"[]", table="character")
+
+        with patch.dict(main.table_versions, {"character": 5}):
+            main.on_version_notify(
+                None, 1, main.VERSION_CHANNEL, '{"table": "character", "version": 4}'
+            )
+            assert main.table_versions["character"] == 5
+
+        assert main.response_cache.get("key") is not None
+
+    def test_malformed_notify_is_logged(self, caplog):
+        with caplog.at_level(logging.WARNING, logger="rickandmorty-app"):
+            main.on_version_notify(None, 1, main.VERSION_CHANNEL, "not json")
+
+        assert "malformed" in caplog.text
+
+    async def test_listener_reconnects_and_catches_up(self):
+        mock_conn = MagicMock()
+        mock_conn.is_closed = MagicMock(side_effect=[False, True, True])
+        mock_conn.add_listener = AsyncMock()
+        mock_conn.execute = AsyncMock()
+        mock_conn.fetch = AsyncMock(return_value=[{"table_name": "character", "version": 9}])
+        connect = AsyncMock(side_effect=[OSError("refused"), mock_conn])
+        sleep = AsyncMock(side_effect=[None, asyncio.CancelledError])
+
+        with (
+            patch("main.asyncpg.connect", connect),
+            patch("main.asyncio.sleep", sleep),
+            patch.dict(main.cache_config, {"listen_keepalive": 0.01}),
+            patch.dict(main.table_versions, {"character": 0}),
+        ):
+            try:
+                await main.listen_table_versions()
+            except asyncio.CancelledError:
+                pass
+            assert main.table_versions["character"] == 9
+
+        assert connect.await_count == 2
+        mock_conn.add_listener.assert_awaited_once_with(
+            main.VERSION_CHANNEL, main.on_version_notify
+        )
+        mock_conn.execute.assert_awaited_once_with("SELECT 1")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Sync jobs — 202 + job id, worker execution, advisory lock dedupe
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestSyncJobs:
+    def setup_method(self):
+        main.sync_jobs.clear()
+        main.sync_active.clear()
+        main.app.state.sync_queue = asyncio.Queue(maxsize=2)
+
+    def test_sync_returns_202_with_job(self):
+        resp = client.post("/sync?source_url=example.com&resource=character")
+
+        assert resp.status_code == 202
+        job_id = resp.json()["job_id"]
+        assert resp.headers["Location"] == f"/sync/{job_id}"
+        assert main.app.state.sync_queue.qsize() == 1
+
+    def test_duplicate_request_returns_same_job(self):
+        first = client.post("/sync?source_url=example.com&resource=character").json()
+        second = client.post("/sync?source_url=example.com&resource=character").json()
+
+        assert first["job_id"] == second["job_id"]
+        assert main.app.state.sync_queue.qsize() == 1
+
+    def test_different_mode_or_filters_get_their_own_job(self):
+        base = "/sync?source_url=example.com&resource=character"
+        incremental = client.post(f"{base}&mode=incremental&filter=status:dead").json()
+
+        full = client.post(f"{base}&mode=full").json()
+
+        assert full["job_id"] != incremental["job_id"]
+        assert main.sync_jobs[full["job_id"]]["mode"] == "full"
+        assert main.sync_jobs[full["job_id"]]["filters"] is None
+        assert main.sync_job_key("example.com", "character", "incremental") != (
+            main.sync_job_key("example.com", "character", "incremental", {"status": "dead"})
+        )
+
+    def test_full_queue_returns_503(self):
+        for _resource in ("character", "location"):
+            client.post(f"/sync?source_url=example.com&resource={_resource}")
+
+        resp = client.post("/sync?source_url=example.com&resource=episode")
+
+        assert resp.status_code == 503
+
+    def test_status_of_known_job(self):
+        job_id = client.post("/sync?source_url=example.com&resource=character").json()["job_id"]
+
+        resp = client.get(f"/sync/{job_id}")
+
+        assert resp.status_code == 200
+        assert resp.json()["status"] == "queued"
+
+    def test_status_of_unknown_job_returns_404(self):
+        mock_conn = MagicMock()
+        mock_conn.fetchval = AsyncMock(return_value=None)
+        main.app.state.pool = _pool(mock_conn)
+
+        resp = client.get("/sync/nope")
+
+        assert resp.status_code == 404
+
+    @pytest.fixture(autouse=True)
+    def _connect_db(self):
+        with patch("main.connect_db", new_callable=AsyncMock) as connect_db:
+            self.connect_db = connect_db
+            yield
+
+    def _lock_conn(self, locked):
+        # Stands in for both the advisory lock connection and the pool's
+        mock_conn = MagicMock()
+        mock_conn.execute = AsyncMock()
+        mock_conn.close = AsyncMock()
+        mock_conn.fetchval = AsyncMock(return_value=locked)
+        self.connect_db.return_value = mock_conn
+        return mock_conn
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_job_runs_under_advisory_lock(self, mock_sync):
+        mock_sync.return_value = {"status": True, "content": {"inserted": 3}}
+        mock_conn = self._lock_conn(True)
+        main.app.state.pool = _pool(mock_conn)
+        job = main.new_sync_job("example.com", "character", "full")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "succeeded"
+        assert job["result"] == {"character": {"inserted": 3}}
+        _unlock = [_call.args[0] for _call in mock_conn.execute.call_args_list]
+        assert "SELECT pg_advisory_unlock(hashtext($1))" in _unlock
+        mock_conn.close.assert_awaited_once()
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_running_job_progress_is_saved(self, mock_sync):
+        async def _sync(source_url, resource, payload, mode, progress):
+            progress["records_synced"] = 20
+            await asyncio.sleep(0.05)
+            return {"status": True, "content": {}}
+
+        mock_sync.side_effect = _sync
+        mock_conn = self._lock_conn(True)
+        main.app.state.pool = _pool(mock_conn)
+        job = main.new_sync_job("example.com", "character", "full")
+
+        with patch.dict(main.sync_jobs_config, {"save_interval": 0.01}):
+            await main.run_sync_job(job)
+
+        _saved = [
+            json.loads(_call.args[3])
+            for _call in mock_conn.execute.call_args_list
+            if "INSERT INTO sync_job" in _call.args[0]
+        ]
+        assert any(
+            _item["status"] == "running" and _item["records_synced"] == 20 for _item in _saved
+        )
+        assert _saved[-1]["status"] == "succeeded"
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_job_skipped_when_locked_elsewhere(self, mock_sync):
+        main.app.state.pool = _pool(self._lock_conn(False))
+        job = main.new_sync_job("example.com", "character", "full")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "skipped"
+        mock_sync.assert_not_awaited()
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_upstream_failure_marks_job_failed(self, mock_sync):
+        mock_sync.return_value = {"status": False, "content": "Request status not OK"}
+        main.app.state.pool = _pool(self._lock_conn(True))
+        job = main.new_sync_job("example.com", "character", "full")
+        errors = _sample("rickandmorty_sync_errors_total", resource="character")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "failed"
+        assert job["errors"] == ["character: Request status not OK"]
+        assert _sample("rickandmorty_sync_errors_total", resource="character") == errors + 1
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_all_syncs_every_resource_into_its_table(self, mock_sync):
+        mock_sync.return_value = {"status": True, "content": {"inserted": 1}}
+        main.app.state.pool = _pool(self._lock_conn(True))
+        job = main.new_sync_job("example.com", "all", "full")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "succeeded"
+        assert set(job["result"]) == {"character", "location", "episode"}
+        _synced = {_call.args[1]: _call.args[2] for _call in mock_sync.call_args_list}
+        assert _synced["character"] == {"species": "Human", "status": "alive", "origin": "Earth"}
+        assert _synced["episode"] == {}
+
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_request_filters_replace_defaults(self, mock_sync):
+        mock_sync.return_value = {"status": True, "content": {}}
+        main.app.state.pool = _pool(self._lock_conn(True))
+        job = main.new_sync_job("example.com", "character", "full", {"status": "dead"})
+
+        await main.run_sync_job(job)
+
+        assert mock_sync.call_args.args[2] == {"status": "dead"}
+
+    @patch("main.refresh_stats", new_callable=AsyncMock)
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_character_writes_refresh_stats(self, mock_sync, mock_refresh):
+        async def _sync(source_url, resource, payload, mode, progress):
+            progress["rows_written"] = 2 if resource == "character" else 5
+            return {"status": True, "content": {}}
+
+        mock_sync.side_effect = _sync
+        mock_conn = self._lock_conn(True)
+        main.app.state.pool = _pool(mock_conn)
+
+        await main.run_sync_job(main.new_sync_job("example.com", "all", "full"))
+
+        mock_refresh.assert_awaited_once_with(mock_conn)
+
+    @patch("main.refresh_stats", new_callable=AsyncMock)
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_unchanged_characters_skip_stats_refresh(self, mock_sync, mock_refresh):
+        async def _sync(source_url, resource, payload, mode, progress):
+            progress["rows_written"] = 0
+            return {"status": True, "content": {}}
+
+        mock_sync.side_effect = _sync
+        main.app.state.pool = _pool(self._lock_conn(True))
+
+        await main.run_sync_job(main.new_sync_job("example.com", "character", "full"))
+
+        mock_refresh.assert_not_awaited()
+
+    @patch("main.refresh_stats", new_callable=AsyncMock)
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_sync_stopped_at_gap_fails_but_refreshes_stats(self, mock_sync, mock_refresh):
+        async def _sync(source_url, resource, payload, mode, progress):
+            progress["rows_written"] = 20
+            return {"status": False, "content": "Sync of character stopped at page 2 of 3"}
+
+        mock_sync.side_effect = _sync
+        main.app.state.pool = _pool(self._lock_conn(True))
+        job = main.new_sync_job("example.com", "character", "full")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "failed"
+        assert job["errors"] == ["character: Sync of character stopped at page 2 of 3"]
+        mock_refresh.assert_awaited_once()
+
+    @patch("main.refresh_stats", new_callable=AsyncMock)
+    @patch("main.sync_resource", new_callable=AsyncMock)
+    async def test_stats_refresh_failure_keeps_sync_result(self, mock_sync, mock_refresh):
+        async def _sync(source_url, resource, payload, mode, progress):
+            progress["rows_written"] = 1
+            return {"status": True, "content": {"inserted": 1}}
+
+        mock_sync.side_effect = _sync
+        mock_refresh.side_effect = asyncpg.PostgresError("boom")
+        main.app.state.pool = _pool(self._lock_conn(True))
+        job = main.new_sync_job("example.com", "character", "full")
+
+        await main.run_sync_job(job)
+
+        assert job["status"] == "succeeded"
+
+    def test_unknown_resource_returns_400(self):
+        resp = client.post("/sync?source_url=example.com&resource=planet")
+        assert resp.status_code == 400
+
+    def test_filters_are_validated_per_resource(self):
+        resp = client.post("/sync?source_url=example.com&resource=episode&filter=status:dead")
+        assert resp.status_code == 400
+
+    def test_filters_stored_on_job(self):
+        resp = client.post(
+            "/sync?source_url=example.com&resource=character&filter=status:dead&filter=name:rick"
+        )
+
+        job = main.sync_jobs[resp.json()["job_id"]]
+        assert job["filters"] == {"status": "dead", "name": "rick"}
+
+    def test_sync_key_depends_on_filters(self):
+        assert main.sync_key("episode", {}) == "episode"
+        assert main.sync_key("character", {"status": "dead", "name": "rick"}) == (
+            "character?name=rick&status=dead"
+        )
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Profiling — request traces, stack profiles, slow query plans
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _logged_query(query, elapsed, args=()):
+    return MagicMock(query=query, args=args, elapsed=elapsed)
+
+
+class TestProfiling:
+    @pytest.fixture(autouse=True)
+    def _profiler(self):
+        main.profiler.configure(token="s3cret", slow_query_ms=100)
+        yield main.profiler
+        main.profiler.configure()
+
+    def _data_conn(self):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=_rows(1, 2))
+        main.app.state.pool = _pool(mock_conn)
+        return mock_conn
+
+    def test_token_header_traces_request(self):
+        self._data_conn()
+
+        resp = client.get(
+            "/data?sort_field=id&sort_order=ASC",
+            headers={"X-Debug-Token": "s3cret", "X-Request-ID": "abc"},
+        )
+
+        trace = main.profiler.find("abc")[0]
+        assert resp.status_code == 200
+        assert trace["name"] == "GET /data"
+        assert trace["status"] == 200
+        assert trace["seconds"] > 0
+        assert {"rate_limit", "pool_acquire", "serialize"} <= trace["spans"].keys()
+        assert trace["profile"] is None
+
+    def test_untraced_without_token_or_sampling(self):
+        self._data_conn()
+
+        client.get("/data?sort_field=id&sort_order=ASC", headers={"X-Debug-Token": "wrong"})
+
+        assert not main.profiler.traces
+
+    def test_sampled_requests_traced(self):
+        self._data_conn()
+        main.profiler.sample_rate = 1.0
+
+        client.get("/data?sort_field=id&sort_order=ASC")
+
+        assert len(main.profiler.traces) == 1
+
+    def test_profile_header_attaches_stacks(self):
+        self._data_conn()
+
+        client.get(
+            "/data?sort_field=id&sort_order=ASC",
+            headers={"X-Debug-Token": "s3cret", "X-Debug-Profile": "1", "X-Request-ID": "p"},
+        )
+
+        profile = main.profiler.find("p")[0]["profile"]
+        assert profile["interval"] == main.profiler.profile_interval
+        assert profile["samples"] == sum(_stack["count"] for _stack in profile["stacks"])
+        assert main.profiler._sampler is None
+
+    def test_sampler_sees_the_busy_function(self):
+        def _busy(sampler):
+            _end = time.perf_counter() + 0.2
+            while time.perf_counter() < _end and not sampler.stacks:
+                pass
+
+        sampler = main.StackSampler(threading.get_ident(), interval=0.001)
+        sampler.start()
+        _busy(sampler)
+        profile = sampler.stop()
+
+        assert "_busy (test_main.py)" in profile["stacks"][0]["stack"]
+
+    @pytest.mark.parametrize(
+        ("token", "status_code"), [(None, 403), ("wrong", 403), ("s3cret", 200)]
+    )
+    def test_debug_routes_need_the_token(self, token, status_code):
+        headers = {"X-Debug-Token": token} if token else {}
+
+        for _path in ("/debug/traces", "/debug/slow-queries"):
+            assert client.get(_path, headers=headers).status_code == status_code
+
+    def test_non_ascii_token_is_refused_not_an_error(self):
+        headers = {"X-Debug-Token": "s3crét".encode("latin-1")}
+
+        assert client.get("/healthz", headers=headers).status_code == 200
+        assert client.get("/debug/traces", headers=headers).status_code == 403
+
+    def test_debug_routes_absent_without_token(self):
+        main.profiler.configure()
+
+        assert client.get("/debug/traces").status_code == 404
+
+    def test_debug_traces_newest_first_without_profiles(self):
+        self._data_conn()
+        for _id in ("a", "b"):
+            client.get(
+                "/data?sort_field=id&sort_order=ASC",
+                headers={"X-Debug-Token": "s3cret", "X-Request-ID": _id},
+            )
+
+        traces = client.get("/debug/traces", headers={"X-Debug-Token": "s3cret"}).json()
+        one = client.get("/debug/traces/a", headers={"X-Debug-Token": "s3cret"})
+        missing = client.get("/debug/traces/zz", headers={"X-Debug-Token": "s3cret"})
+
+        assert [_trace["trace_id"] for _trace in traces] == ["b", "a"]
+        assert one.json()["trace_id"] == "a"
+        assert "_start" not in one.json()
+        assert missing.status_code == 404
+
+    def test_traces_bounded(self):
+        main.profiler.configure(token="s3cret", max_traces=2)
+
+        for _id in range(3):
+            main.profiler.finish(main.profiler.start(str(_id), "GET /data"), 200)
+
+        assert [_trace["trace_id"] for _trace in main.profiler.traces] == ["1", "2"]
+
+    async def test_slow_select_explained(self):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(return_value=[("Seq Scan on character",)])
+        main.app.state.pool = _pool(mock_conn)
+
+        main.profiler.observe_query(_logged_query("SELECT data FROM character", 0.5, (1,)))
+        main.profiler.observe_query(_logged_query("SELECT data FROM character", 0.2, (1,)))
+        await main.profiler._explain_task
+
+        entry = main.profiler.slow_queries["SELECT data FROM character"]
+        assert entry["count"] == 2
+        assert entry["max_ms"] == 500
+        assert entry["plan"] == ["Seq Scan on character"]
+        assert mock_conn.fetch.call_args.args == (
+            "EXPLAIN (ANALYZE, BUFFERS) SELECT data FROM character",
+            1,
+        )
+        mock_conn.transaction.assert_called_once_with(readonly=True)
+
+    async def test_explain_failure_recorded(self):
+        mock_conn = MagicMock()
+        mock_conn.fetch = AsyncMock(side_effect=asyncpg.UndefinedTableError("gone"))
+        main.app.state.pool = _pool(mock_conn)
+
+        main.profiler.observe_query(_logged_query("SELECT 1 FROM character_staging", 0.5))
+        await main.profiler._explain_task
+
+        assert main.profiler.slow_queries["SELECT 1 FROM character_staging"]["error"] == "gone"
+
+    async def test_fast_writes_and_explains_not_captured_or_explained(self):
+        main.profiler.observe_query(_logged_query("SELECT 1", 0.01))
+        main.profiler.observe_query(_logged_query("EXPLAIN (ANALYZE, BUFFERS) SELECT 1", 1))
+        main.profiler.observe_query(_logged_query("INSERT INTO character VALUES (1)", 1))
+
+        assert list(main.profiler.slow_queries) == ["INSERT INTO character VALUES (1)"]
+        assert main.profiler._explain_task is None
+
+    async def test_slow_queries_bounded(self):
+        main.profiler.configure(slow_query_ms=100, max_slow_queries=2)
+
+        for _table in ("a", "b", "c"):
+            main.profiler.observe_query(_logged_query(f"DELETE FROM {_table}", 1))
+
+        assert list(main.profiler.slow_queries) == ["DELETE FROM b", "DELETE FROM c"]
+
+    @patch("main.run_sync_job", new_callable=AsyncMock)
+    async def test_traced_sync_request_traces_its_job(self, mock_run):
+        main.app.state.sync_queue = asyncio.Queue()
+        job = main.new_sync_job("example.com", "character", "full")
+        job["status"] = "succeeded"
+        main.profiler.jobs[job["job_id"]] = False
+        await main.app.state.sync_queue.put(job)
+
+        worker = asyncio.create_task(main.sync_worker())
+        await main.app.state.sync_queue.join()
+        worker.cancel()
+
+        trace = main.profiler.find(job["job_id"])[0]
+        assert trace["name"] == "sync character"
+        assert trace["status"] == "succeeded"
+        assert not main.profiler.jobs
+
+    def test_sync_request_marks_job_for_tracing(self):
+        main.sync_active.clear()
+        main.app.state.sync_queue = asyncio.Queue()
+
+        resp = client.post(
+            "/sync?source_url=example.com&resource=episode", headers={"X-Debug-Token": "s3cret"}
+        )
+
+        assert main.profiler.jobs == {resp.json()["job_id"]: False}
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Rate limiting — per-client token buckets, shared stores, route costs
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestRateLimit:
+    async def test_bucket_drains_and_refills(self):
+        store = main.MemoryBucketStore()
+
+        with patch("main.time.monotonic", return_value=100.0):
+            results = [(await store.take("k", 1, 3, 1))[0] for _ in range(4)]
+        with patch("main.time.monotonic", return_value=101.0):
+            refilled, _ = await store.take("k", 1, 3, 1)
+
+        assert results == [True, True, True, False]
+        assert refilled
+
+    async def test_shared_memory_buckets_shared_between_processes(self, tmp_path):
+        # Two stores on one file stand in for two uvicorn workers
+        first = main.SharedMemoryBucketStore(str(tmp_path / "buckets"), slots=16)
+        second = main.SharedMemoryBucketStore(str(tmp_path / "buckets"), slots=16)
+
+        with patch("main.time.monotonic", return_value=100.0):
+            assert (await first.take("ip:1", 10, 15, 1))[0]
+            allowed, tokens = await second.take("ip:1", 10, 15, 1)
+
+        assert not allowed
+        assert tokens == 5
+
+    async def test_shared_memory_keys_are_independent(self, tmp_path):
+        store = main.SharedMemoryBucketStore(str(tmp_path / "buckets"), slots=4096)
+
+        with patch("main.time.monotonic", return_value=100.0):
+            await store.take("ip:1", 10, 10, 1)
+            allowed, _ = await store.take("ip:2", 10, 10, 1)
+
+        assert allowed
+
+    async def test_postgres_store_fails_open(self):
+        main.app.state.pool = _pool(acquire_side_effect=TimeoutError())
+
+        allowed, _ = await main.PostgresBucketStore().take("ip:1", 1, 50, 50)
+
+        assert allowed
+
+    def test_sync_costs_more_than_data(self):
+        statuses = [
+            client.post("/sync?source_url=example.com&resource=character&mode=fast").status_code
+            for _ in range(6)
+        ]
+
+        assert statuses == [400] * 5 + [429]
+
+    def test_429_carries_retry_after(self):
+        for _ in range(5):
+            client.post("/sync?source_url=example.com&resource=character&mode=fast")
+
+        resp = client.post("/sync?source_url=example.com&resource=character&mode=fast")
+
+        assert resp.status_code == 429
+        assert int(resp.headers["Retry-After"]) >= 1
+
+    def test_issued_api_key_gets_its_own_bucket(self):
+        for _ in range(5):
+            client.post("/sync?source_url=example.com&resource=character&mode=fast")
+
+        with patch.object(main.rate_limiter, "api_keys", {main.rate_limiter.key_hash("issued")}):
+            resp = client.post(
+                "/sync?source_url=example.com&resource=character&mode=fast",
+                headers={"X-API-Key": "issued"},
+            )
+
+        assert resp.status_code == 400
+
+    def test_unknown_api_keys_share_the_ip_bucket(self):
+        statuses = [
+            client.post(
+                "/sync?source_url=example.com&resource=character&mode=fast",
+                headers={"X-API-Key": f"made-up-{_n}"},
+            ).status_code
+            for _n in range(6)
+        ]
+
+        assert statuses == [400] * 5 + [429]
+
+    def test_probes_are_not_limited(self):
+        for _ in range(5):
+            client.post("/sync?source_url=example.com&resource=character&mode=fast")
+
+        assert client.get("/healthz").status_code == 200
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Prometheus metrics
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+def _sample(name, **labels):
+    return main.REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestMetrics:
+    def test_requests_counted_per_route_template(self):
+        labels = {"method": "GET", "route": "/sync/{job_id}", "status": "404"}
+        before = _sample("http_requests_total", **labels)
+
+        mock_conn = MagicMock()
+        mock_conn.fetchval = AsyncMock(return_value=None)
+        main.app.state.pool = _pool(mock_conn)
+
+        client.get("/sync/abc")
+
+        assert _sample("http_requests_total", **labels) == before + 1
+        assert (
+            _sample("http_request_duration_seconds_count", method="GET", route="/sync/{job_id}")
+            >= 1
+        )
+
+    def test_unknown_path_is_not_a_label(self):
+        client.get("/no/such/path")
+
+        assert _sample("http_requests_total", method="GET", route="unmatched", status="404") >= 1
+        assert (
+            _sample("http_requests_total", method="GET", route="/no/such/path", status="404") == 0
+        )
+
+    def test_metrics_endpoint_exposes_alerting_series(self):
+        client.get("/db-mon?aspect=cache")
+
+        resp = client.get("/metrics")
+
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/plain")
+        assert "http_requests_total{" in resp.text
+        assert "http_request_duration_seconds_bucket{" in resp.text
+        assert "rickandmorty_cache_hits_total" in resp.text
+        assert "rickandmorty_db_pool_timeouts_total" in resp.text
+
+    async def test_query_logger_registered_on_new_connections(self):
+        mock_conn = MagicMock()
+        before = _sample("rickandmorty_db_query_duration_seconds_count")
+
+        await main.init_db_connection(mock_conn)
+        observe = mock_conn.add_query_logger.call_args.args[0]
+        observe(MagicMock(elapsed=0.002))
+
+        assert _sample("rickandmorty_db_query_duration_seconds_count") == before + 1
+
+    async def test_upstream_latency_observed_per_attempt(self):
+        before = _sample("rickandmorty_upstream_request_duration_seconds_count", status="503")
+
+        with patch("main.asyncio.sleep", new_callable=AsyncMock):
+            await main.rget(_client(_response(503), _response(200, {})), "u", {})
+
+        assert (
+            _sample("rickandmorty_upstream_request_duration_seconds_count", status="503")
+            == before + 1
+        )
+
+    async def test_pool_wait_observed(self):
+        main.app.state.pool = _pool(MagicMock())
+        before = _sample("rickandmorty_db_pool_acquire_seconds_count")
+
+        async with main.db_acquire():
+            pass
+
+        assert _sample("rickandmorty_db_pool_acquire_seconds_count") == before + 1
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# App factory & server entry point
+# ─────────────────────────────────────────────────────────────────────────────
+
+
+class TestAppFactory:
+    @pytest.fixture(autouse=True)
+    def _restore_config(self, monkeypatch, tmp_path):
+        monkeypatch.delenv("RICKANDMORTY_CONFIG", raising=False)
+        monkeypatch.delenv("RICKANDMORTY_SECRET", raising=False)
+        # Multi-worker runs point this at their metrics files; keep them here
+        (tmp_path / "metrics").mkdir()
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path / "metrics"))
+        yield
+        main.load_config(str(_tmp / "config.yaml"), str(_tmp / "secrets.json"))
+
+    def _config(self, text):
+        path = _tmp / "factory.yaml"
+        path.write_text(text)
+        return str(path)
+
+    def test_import_reads_no_files(self):
+        result = subprocess.run(
+            [sys.executable, "-c", "import main; assert main.db_config == {}"],
+            cwd=pathlib.Path(main.__file__).parent,
+            capture_output=True,
+        )
+
+        assert result.returncode == 0, result.stderr
+
+    def test_load_config_fills_sections_in_place(self):
+        sections = main.upstream_config
+
+        main.load_config(
+            self._config(
+                "log_level: WARNING\nupstream:\n  max_retries: 7\n"
+                "rate_limit:\n  store: memory\n  costs:\n    /data: 2\n"
+            ),
+            str(_tmp / "secrets.json"),
+        )
+
+        assert sections is main.upstream_config
+        assert main.upstream_config == {"max_retries": 7}
+        assert main.logger.level == logging.WARNING
+        assert isinstance(main.rate_limiter.store, main.MemoryBucketStore)
+        assert main.rate_limiter.costs == {"/sync": 10, "/export": 10, "/data": 2}
+
+    def test_create_app_reads_paths_from_env(self, monkeypatch):
+        monkeypatch.setenv("RICKANDMORTY_CONFIG", self._config("log_level: INFO\ndata: {a: 1}\n"))
+        monkeypatch.setenv("RICKANDMORTY_SECRET", str(_tmp / "secrets.json"))
+
+        assert main.create_app() is main.app
+        assert main.data_config == {"a": 1}
+
+    def test_production_mode(self, monkeypatch, tmp_path):
+        config = self._config(
+            "log_level: INFO\nserver:\n  workers: 3\n  graceful_timeout: 15\n"
+            f"  metrics_dir: {tmp_path}\n"
+        )
+        (tmp_path / "counter_123.db").write_bytes(b"stale")
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR")
+
+        with patch("main.uvicorn.run") as run:
+            main.main(["--config", config, "--secret", str(_tmp / "secrets.json")])
+
+        args, kwargs = run.call_args
+        assert args == ("main:create_app",)
+        assert kwargs["factory"] is True
+        assert kwargs["workers"] == 3
+        assert kwargs["loop"] == "uvloop"
+        assert kwargs["http"] == "httptools"
+        assert kwargs["timeout_graceful_shutdown"] == 15
+        assert "reload" not in kwargs
+        assert main.os.environ["RICKANDMORTY_CONFIG"] == config
+        assert main.os.environ["PROMETHEUS_MULTIPROC_DIR"] == str(tmp_path)
+        assert not (tmp_path / "counter_123.db").exists()
+
+    def test_workers_share_metrics_in_multiprocess_mode(self, tmp_path):
+        # Two processes stand in for two uvicorn workers of one pod
+        worker = (
+            "import main\n"
+            "main.response_cache.hits = 3\n"
+            "main.publish_state_metrics()\n"
+            "main.HTTP_REQUESTS.labels('GET', '/data', '200').inc()\n"
+        )
+        scrape = "import asyncio, main\nprint(asyncio.run(main.metrics()).body.decode())\n"
+        env = {**main.os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+        cwd = pathlib.Path(main.__file__).parent
+
+        for code in (worker, worker, scrape):
+            result = subprocess.run(
+                [sys.executable, "-c", code], cwd=cwd, env=env, capture_output=True, text=True
+            )
+            assert result.returncode == 0, result.stderr
+
+        assert "rickandmorty_cache_hits_total 6.0" in result.stdout
+        assert 'http_requests_total{method="GET",route="/data",status="200"} 2.0' in result.stdout
+
+    def test_workers_flag_overrides_config(self):
+        with patch("main.uvicorn.run") as run:
+            main.main(
+                [
+                    "--config",
+                    str(_tmp / "config.yaml"),
+                    "--secret",
+                    str(_tmp / "secrets.json"),
+                    "--workers",
+                    "4",
+                ]
+            )
+
+        assert run.call_args.kwargs["workers"] == 4
+
+    def test_reload_is_opt_in(self):
+        with patch("main.uvicorn.run") as run:
+            main.main(
+                [
+                    "--config",
+                    str(_tmp / "config.yaml"),
+                    "--secret",
+                    str(_tmp / "secrets.json"),
+                    "--reload",
+                ]
+            )
+
+        assert run.call_args.kwargs["reload"] is True
+        assert "workers" not in run.call_args.kwargs